@@ -0,0 +1,81 @@
+# Measures what a short-lived worker pays before its first row: importing
+# `census`, constructing `Census`, and a first small pull with and without
+# catalog validation. Each step runs in a fresh interpreter against the
+# local replay server, with a fresh cache directory.
+#
+#   python benchmarks/bench_startup.py [--repeat N]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from json import loads
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from replay_server import start
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SETUP = '''
+import sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import census
+'''
+
+STEPS = {
+    'import census': '',
+    'import + Census()': '''
+c = census.Census('benchmark', cache_dir={cache_dir!r}, base_url={url!r} + '/data')
+''',
+    'first pull, validated': '''
+c = census.Census('benchmark', cache_dir={cache_dir!r}, base_url={url!r} + '/data')
+c.set_year(2020)
+c.set_api('acs')
+c.set_database('acs5')
+c.set_table('detail')
+c.set_variables('NAME', 'B00000_001E')
+c.set_geography('state')
+c.pull_data()
+''',
+    'first pull, validate=False': '''
+c = census.Census('benchmark', cache_dir={cache_dir!r}, base_url={url!r} + '/data', validate=False)
+c.execute(census.CensusQuery('2020', 'acs', 'acs5', 'detail', ['NAME', 'B00000_001E'], 'state'))
+''',
+}
+
+REPORT = '''
+print(time.perf_counter() - start, sorted(m for m in ('pandas', 'numpy', 'requests') if m in sys.modules))
+'''
+
+
+def run(step, url):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        code = (SETUP + STEPS[step] + REPORT).format(root=ROOT, cache_dir=cache_dir, url=url)
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    seconds, modules = out.strip().splitlines()[-1].split(' ', 1)
+    return float(seconds), loads(modules.replace("'", '"'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time import and first use of the Census client.')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    server, url = start()
+    try:
+        # Build the server's generated documents before timing anything.
+        run('first pull, validated', url)
+        print(f'{"step":<30}{"median ms":>12}{"min ms":>10}  heavy modules loaded')
+        for step in STEPS:
+            results = [run(step, url) for _ in range(args.repeat)]
+            times = [seconds * 1000 for seconds, _ in results]
+            print(f'{step:<30}{statistics.median(times):>12.1f}{min(times):>10.1f}  {", ".join(results[-1][1]) or "-"}')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Compares the old nested-loop construction of the concept/variable frame
+# with `build_variables_frame` on a variables.json of ACS5 detail size.
+#
+#   python benchmarks/bench_variables_frame.py [path/to/variables.json]
+import os
+import sys
+import time
+from json import loads
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd
+
+from census import build_variables_frame
+from fixtures import make_variables
+
+
+def legacy_variables_frame(variables):
+    data = {}
+    for variable in variables.keys():
+        if 'concept' in variables[variable]:
+            concept = variables[variable]['concept']
+            if concept not in data:
+                data[concept] = []
+            new_variable = {'variable': variable}
+            new_variable.update(variables[variable])
+            del new_variable['concept']
+            data[concept].append(new_variable)
+
+    columns = ['concept']
+    for key in data.keys():
+        for variable in data[key]:
+            for v_key in variable.keys():
+                if v_key not in columns:
+                    columns.append(v_key)
+    dataframe = {}
+    for column in columns:
+        dataframe[column] = []
+
+    for key in data.keys():
+        for variable in data[key]:
+            dataframe['concept'].append(key)
+            for v_key in variable.keys():
+                dataframe[v_key].append(variable[v_key])
+                max_col_len = len(dataframe[v_key])
+            for col in dataframe.keys():
+                if len(dataframe[col]) < max_col_len:
+                    dataframe[col].append(None)
+    return pd.DataFrame(dataframe)
+
+
+def best_of(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            variables = loads(f.read())['variables']
+    else:
+        variables = make_variables()['variables']
+
+    legacy_time, legacy = best_of(lambda: legacy_variables_frame(variables))
+    new_time, new = best_of(lambda: build_variables_frame(variables))
+
+    assert len(legacy) == len(new)
+    assert list(legacy['variable']) == list(new['variable'])
+
+    print(f'variables: {len(variables)}')
+    print(f'legacy:    {legacy_time * 1000:9.1f} ms  {legacy.memory_usage(deep=True).sum() / 1e6:7.1f} MB')
+    print(f'columnar:  {new_time * 1000:9.1f} ms  {new.memory_usage(deep=True).sum() / 1e6:7.1f} MB')
+    print(f'speedup:   {legacy_time / new_time:9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
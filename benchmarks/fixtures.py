@@ -0,0 +1,87 @@
+# Synthetic Census API documents with the shape and size of the real ones.
+# Used by the benchmarks so they can run without network access.
+import random
+
+
+def make_variables(n_groups=1200, per_group=15, seed=0):
+    rng = random.Random(seed)
+    words = ['Total', 'Male', 'Female', 'Under 5 years', 'Median household income', 'in the past 12 months',
+             'Below poverty level', 'With a disability', 'White alone', 'Black or African American alone',
+             'Hispanic or Latino', 'Owner occupied', 'Renter occupied', 'Bachelor\'s degree', 'Worked full-time']
+    variables = {
+        'for': {'label': 'Census API FIPS \'for\' clause', 'concept': 'Census API Geography Specification', 'predicateType': 'fips-for', 'group': 'N/A', 'limit': 0, 'predicateOnly': True},
+        'in': {'label': 'Census API FIPS \'in\' clause', 'concept': 'Census API Geography Specification', 'predicateType': 'fips-in', 'group': 'N/A', 'limit': 0, 'predicateOnly': True},
+        'ucgid': {'label': 'Uniform Census Geography Identifier clause', 'predicateType': 'ucgid', 'group': 'N/A', 'limit': 0, 'predicateOnly': True, 'hasGeoCollectionSupport': True},
+        'NAME': {'label': 'Geographic Area Name', 'concept': 'Geography', 'predicateType': 'string', 'group': 'N/A', 'limit': 0},
+        'GEO_ID': {'label': 'Geography', 'concept': 'Geography', 'predicateType': 'string', 'group': 'N/A', 'limit': 0},
+    }
+    for g in range(n_groups):
+        prefix = 'BC'[g % 2]
+        group = f'{prefix}{g:05d}'
+        concept = ' BY '.join(rng.sample(words, 3)).upper()
+        for i in range(1, per_group + 1):
+            label = 'Estimate!!' + '!!'.join(rng.sample(words, rng.randint(1, 4))) + ':'
+            base = f'{group}_{i:03d}'
+            variables[base + 'E'] = {'label': label, 'concept': concept, 'predicateType': 'int', 'group': group, 'limit': 0,
+                                     'attributes': f'{base}EA,{base}M,{base}MA'}
+            variables[base + 'M'] = {'label': 'Margin of Error!!' + label[len('Estimate!!'):], 'concept': concept,
+                                     'predicateType': 'int', 'group': group, 'limit': 0}
+    return {'variables': variables}
+
+
+STATE_CODES = ['01', '02', '04', '05', '06', '08', '09', '10', '11', '12', '13', '15', '16', '17', '18', '19', '20',
+               '21', '22', '23', '24', '25', '26', '27', '28', '29', '30', '31', '32', '33', '34', '35', '36', '37',
+               '38', '39', '40', '41', '42', '44', '45', '46', '47', '48', '49', '50', '51', '53', '54', '55', '56', '72']
+
+
+def make_catalog(years=range(2010, 2023)):
+    datasets = []
+    for year in years:
+        for path in (['acs', 'acs1'], ['acs', 'acs1', 'subject'], ['acs', 'acs1', 'profile'],
+                     ['acs', 'acs5'], ['acs', 'acs5', 'subject'], ['acs', 'acs5', 'profile'], ['acs', 'acs5', 'cprofile'],
+                     ['dec', 'pl'], ['cbp'], ['pep', 'population']):
+            url = f'https://api.census.gov/data/{year}/' + '/'.join(path)
+            datasets.append({
+                'c_vintage': year,
+                'c_dataset': path,
+                'title': f'{" ".join(path).upper()} {year}: American Community Survey estimates of income, poverty and housing',
+                'description': 'The American Community Survey (ACS) is an ongoing survey that provides data every year. ' * 3,
+                'keyword': ['census', 'income', 'poverty', 'housing'],
+                'distribution': [{'accessURL': url, 'format': 'API'}],
+                'c_variablesLink': url + '/variables.json',
+                'c_geographyLink': url + '/geography.json',
+                'c_groupsLink': url + '/groups.json',
+            })
+    return {'dataset': datasets}
+
+
+def make_geography():
+    return {'fips': [
+        {'name': 'us', 'geoLevelDisplay': '010', 'referenceDate': '2020-01-01'},
+        {'name': 'state', 'geoLevelDisplay': '040', 'referenceDate': '2020-01-01'},
+        {'name': 'county', 'geoLevelDisplay': '050', 'referenceDate': '2020-01-01', 'requires': ['state'], 'wildcard': ['state'], 'optionalWithWCFor': 'state'},
+        {'name': 'tract', 'geoLevelDisplay': '140', 'referenceDate': '2020-01-01', 'requires': ['state', 'county'], 'wildcard': ['county'], 'optionalWithWCFor': 'county'},
+    ]}
+
+
+def make_groups(variables):
+    groups = {}
+    for name, metadata in variables['variables'].items():
+        if metadata.get('group', 'N/A') != 'N/A':
+            groups.setdefault(metadata['group'], metadata['concept'])
+    return {'groups': [{'name': name, 'description': concept, 'variables': ''} for name, concept in groups.items()]}
+
+
+def make_geographies(counties_per_state=62, tracts_per_county=26):
+    # About 3,200 counties and 85,000 tracts, like the real country.
+    states = {state: f'State {state}' for state in STATE_CODES}
+    counties = {}
+    tracts = {}
+    for state in STATE_CODES:
+        for c in range(1, counties_per_state + 1):
+            county = f'{2 * c - 1:03d}'
+            counties[(state, county)] = f'County {county}, State {state}'
+            for t in range(1, tracts_per_county + 1):
+                tract = f'{t * 100:06d}'
+                tracts[(state, county, tract)] = f'Census Tract {t}; County {county}; State {state}'
+    return {'us': {('1',): 'United States'}, 'state': {(s,): n for s, n in states.items()}, 'county': counties, 'tract': tracts}
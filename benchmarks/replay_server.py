@@ -0,0 +1,230 @@
+# A local stand-in for api.census.gov.
+#
+# Responses recorded from the real API (see `record`) are replayed as they
+# were. Anything that was not recorded is generated: the catalog, metadata
+# documents of ACS5 detail size, and data responses for us/state/county/tract
+# with the real number of geographies, so large pulls have realistic sizes.
+#
+#   python benchmarks/replay_server.py serve [--port 8000] [--fixtures DIR]
+#   python benchmarks/replay_server.py record --fixtures DIR --key KEY URL...
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from json import dumps
+from urllib.parse import urlsplit, parse_qsl
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import make_catalog, make_geography, make_geographies, make_groups, make_variables
+
+SENTINEL = '-666666666'
+
+
+def fixture_name(path, query):
+    # Recorded responses are stored under a hash of the path and the
+    # parameters without the key.
+    params = sorted((name, value) for name, value in parse_qsl(query, keep_blank_values=True) if name != 'key')
+    return hashlib.sha1((path + '?' + repr(params)).encode()).hexdigest() + '.json'
+
+
+class Replay:
+    def __init__(self, fixtures=None, seed=0):
+        self.fixtures = fixtures
+        self.seed = seed
+        self.__lock = threading.RLock()
+        self.__objects = {}
+        self.__documents = {}
+        self.__responses = {}
+
+    def value(self, name, build):
+        with self.__lock:
+            if name not in self.__objects:
+                self.__objects[name] = build()
+            return self.__objects[name]
+
+    def document(self, name, build):
+        value = self.value(name, build)
+        with self.__lock:
+            if name not in self.__documents:
+                self.__documents[name] = dumps(value).encode()
+            return self.__documents[name]
+
+    def recorded(self, path, query):
+        if self.fixtures is None:
+            return None
+        file = os.path.join(self.fixtures, fixture_name(path, query))
+        if os.path.exists(file):
+            with open(file, 'rb') as f:
+                return f.read()
+        return None
+
+    def respond(self, path, query):
+        body = self.recorded(path, query)
+        if body is not None:
+            return 200, body
+        if path == '/data.json':
+            return 200, self.document('catalog', make_catalog)
+        if path.endswith('/variables.json'):
+            return 200, self.document('variables', make_variables)
+        if path.endswith('/geography.json'):
+            return 200, self.document('geography', make_geography)
+        if path.endswith('/groups.json'):
+            return 200, self.document('groups', lambda: make_groups(self.value('variables', make_variables)))
+        params = parse_qsl(query)
+        if any(name == 'get' for name, _ in params):
+            # Generated responses are deterministic, so build each once and
+            # keep the server out of the measurements on repeated runs.
+            key = tuple(sorted((name, value) for name, value in params if name != 'key'))
+            with self.__lock:
+                response = self.__responses.get(key)
+            if response is None:
+                response = self.data(params)
+                with self.__lock:
+                    self.__responses[key] = response
+            return response
+        return 404, b'{"error": "unknown endpoint"}'
+
+    @staticmethod
+    def index_geographies():
+        index = {}
+        for level, rows in make_geographies().items():
+            index[level] = {}
+            for key, name in rows.items():
+                index[level].setdefault(key[0], []).append([*key, name])
+        return index
+
+    def data(self, params):
+        get = [value for name, value in params if name == 'get'][0].split(',')
+        level, _, values = [value for name, value in params if name == 'for'][0].partition(':')
+        parents = dict(value.split(':', 1) for name, value in params if name == 'in')
+        geographies = self.value('geographies', self.index_geographies)
+        if level not in geographies:
+            return 400, b'error: unknown/unsupported geography hierarchy'
+        if level == 'tract' and parents.get('state', '*') == '*':
+            return 400, b'error: unknown/unsupported geography hierarchy'
+
+        columns = {'us': ['us'], 'state': ['state'], 'county': ['state', 'county'], 'tract': ['state', 'county', 'tract']}[level]
+        wanted = [parents.get(column, '*').split(',') for column in columns[:-1]] + [values.split(',')]
+
+        variables = []
+        for item in get:
+            if item.startswith('group('):
+                group = item[6:-1]
+                members = [v for v, m in self.value('variables', make_variables)['variables'].items() if m.get('group') == group]
+                variables += members + [v + 'A' for v in members]
+            else:
+                variables.append(item)
+        if len(get) > 50:
+            return 400, b'error: You can only request up to 50 variables'
+
+        rng = random.Random(zlib.crc32(repr(params).encode()) ^ self.seed)
+        out = [variables + columns]
+        # Rows are indexed by their first code so a per-state request does
+        # not scan the whole country.
+        by_first = geographies[level]
+        first = wanted[0] if wanted[0] != ['*'] else list(by_first)
+        for row in (row for code in first for row in by_first.get(code, ())):
+            codes, name = row[:-1], row[-1]
+            if not all(w == ['*'] or code in w for code, w in zip(codes, wanted)):
+                continue
+            values_row = []
+            for variable in variables:
+                if variable == 'NAME':
+                    values_row.append(name)
+                elif variable == 'GEO_ID':
+                    values_row.append('1400000US' + ''.join(codes))
+                elif variable.endswith('A'):
+                    values_row.append(None)
+                else:
+                    values_row.append(SENTINEL if rng.random() < 0.02 else str(rng.randint(0, 250000)))
+            out.append(values_row + codes)
+        if len(out) == 1:
+            return 204, b''
+        return 200, dumps(out).encode()
+
+
+def make_handler(replay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            status, body = replay.respond(parts.path, parts.query)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def start(fixtures=None, port=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(Replay(fixtures)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def serve(fixtures, queue):
+    server, url = start(fixtures)
+    queue.put(url)
+    threading.Event().wait()
+
+
+def start_process(fixtures=None):
+    # Runs the server in a child process, so building responses does not
+    # compete for the GIL with the client being measured.
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(fixtures, queue), daemon=True)
+    process.start()
+    return process, queue.get(timeout=60)
+
+
+def record(fixtures, key, urls):
+    os.makedirs(fixtures, exist_ok=True)
+    for url in urls:
+        parts = urlsplit(url)
+        separator = '&' if parts.query else '?'
+        with urlopen(url + (f'{separator}key={key}' if key and parts.query else '')) as r:
+            body = r.read()
+        with open(os.path.join(fixtures, fixture_name(parts.path, parts.query)), 'wb') as f:
+            f.write(body)
+        print(f'{len(body):>12} {url}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for api.census.gov.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--fixtures')
+    rec = commands.add_parser('record')
+    rec.add_argument('--fixtures', required=True)
+    rec.add_argument('--key')
+    rec.add_argument('urls', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.fixtures, args.key, args.urls)
+    else:
+        server, url = start(args.fixtures, args.port)
+        print(f'Serving on {url}/data')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
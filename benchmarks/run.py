@@ -0,0 +1,151 @@
+# Benchmark suite for the Census client, run against the local replay server
+# so results do not depend on the live API.
+#
+#   python benchmarks/run.py [--fixtures DIR] [--only NAME ...] [--json FILE] [--no-memory]
+#
+# Each scenario runs once untimed so the server has built its responses,
+# then once timed. It reports wall time, rows, rows per second, peak Python
+# memory (tracemalloc, measured in a third run) and the time spent in each
+# instrumented stage (see `Stats`).
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from json import dumps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from census import Census, CensusQuery, MetadataCache, Stats
+from replay_server import start_process
+
+WIDE = ['NAME'] + [f'B{g:05d}_{i:03d}{kind}' for g in range(0, 16, 2) for i in range(1, 9) for kind in 'EM']
+NARROW = ['NAME'] + [f'B{g:05d}_001E' for g in range(0, 38, 2)]
+PAIRED = ['NAME'] + [f'B{g:05d}_{i:03d}{kind}' for g in range(0, 6, 2) for i in range(1, 9) for kind in 'EM']
+
+
+class Bench:
+    def __init__(self, url, fixtures_cache):
+        self.url = url
+        self.cache_dir = fixtures_cache
+
+    def client(self, stats, cache_dir=None):
+        return Census('benchmark', cache_dir=cache_dir or self.cache_dir, base_url=self.url + '/data',
+                      metadata_cache=MetadataCache(), stats=stats)
+
+    def query(self, variables, geography, **kwargs):
+        return CensusQuery('2020', 'acs', 'acs5', 'detail', variables, geography, **kwargs)
+
+    # Each scenario takes a fresh Stats and returns the number of rows.
+    def startup_cold(self, stats):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self.client(stats, cache_dir).get_api_options()
+        finally:
+            shutil.rmtree(cache_dir)
+        return 0
+
+    def startup_warm(self, stats):
+        self.client(stats).get_api_options()
+        return 0
+
+    def variables_frame(self, stats):
+        c = self.client(stats)
+        c.set_year(2020)
+        c.set_api('acs')
+        c.set_database('acs5')
+        c.set_table('subject')
+        return len(c.pull_concepts_and_variables(as_dataframe=True))
+
+    def states_wide(self, stats):
+        return len(self.client(stats).execute(self.query(WIDE, 'state'), as_dataframe=True))
+
+    def counties_wide(self, stats):
+        return len(self.client(stats).execute(self.query(WIDE, 'county'), as_dataframe=True))
+
+    def tracts(self, stats):
+        return len(self.client(stats).execute(self.query(NARROW, 'tract'), as_dataframe=True))
+
+    def tracts_labelled(self, stats):
+        return len(self.client(stats).execute(self.query(NARROW, 'tract'), as_dataframe=True, labelled=True))
+
+    def tracts_streamed(self, stats):
+        return sum(len(df) for df in self.client(stats).iter_query(self.query(NARROW, 'tract'), batch_size=20000))
+
+    def tracts_compact(self, stats):
+        return len(self.client(stats).execute(self.query(PAIRED, 'tract'), as_dataframe=True, compact=True))
+
+    def tracts_group(self, stats):
+        query = self.query(['NAME'], 'tract', groups=['B00000'], annotations=False)
+        return len(self.client(stats).execute(query, as_dataframe=True))
+
+
+SCENARIOS = ['startup_cold', 'startup_warm', 'variables_frame', 'states_wide', 'counties_wide',
+             'tracts', 'tracts_labelled', 'tracts_streamed', 'tracts_compact', 'tracts_group']
+
+
+def measure(bench, name, memory=True, warmup=True):
+    if warmup:
+        getattr(bench, name)(Stats())
+    stats = Stats()
+    start = time.perf_counter()
+    rows = getattr(bench, name)(stats)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        getattr(bench, name)(Stats())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    snapshot = stats.snapshot()
+    return {
+        'scenario': name,
+        'seconds': elapsed,
+        'rows': rows,
+        'rows_per_second': rows / elapsed if rows else None,
+        'peak_bytes': peak,
+        'stages': {stage: t['total'] for stage, t in snapshot['stages'].items()},
+        'counters': snapshot['counters'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Census client against a local replay server.')
+    parser.add_argument('--fixtures', help='directory of recorded responses (see replay_server.py record)')
+    parser.add_argument('--only', nargs='+', choices=SCENARIOS)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    args = parser.parse_args()
+
+    server, url = start_process(args.fixtures)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        bench = Bench(url, cache_dir)
+        # Warm the server's generated documents and the catalog snapshot.
+        bench.client(Stats()).get_api_options()
+
+        results = []
+        print(f'{"scenario":<18}{"seconds":>10}{"rows":>10}{"rows/s":>12}{"peak MB":>10}  stages (s)')
+        for name in args.only or SCENARIOS:
+            r = measure(bench, name, not args.no_memory)
+            results.append(r)
+            stages = ' '.join(f'{stage}={total:.3f}' for stage, total in sorted(r['stages'].items(), key=lambda item: -item[1]))
+            rate = f'{r["rows_per_second"]:>12,.0f}' if r['rows_per_second'] else f'{"-":>12}'
+            peak = f'{r["peak_bytes"] / 1e6:>10.1f}' if r['peak_bytes'] is not None else f'{"-":>10}'
+            print(f'{name:<18}{r["seconds"]:>10.3f}{r["rows"]:>10}{rate}{peak}  {stages}')
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                f.write(dumps(results, indent=2))
+    finally:
+        server.terminate()
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
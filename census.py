@@ -1,50 +1,1451 @@
-from json import loads
-import requests
-import pandas as pd
-from wasabi import msg
-import ast
+from json import loads, dumps, JSONDecoder, JSONDecodeError
+import importlib
+import codecs
+import contextvars
+import gzip
+import os
+import zlib
+import time
+import threading
+import re
+import random
+import sys
+import logging
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import islice
+from operator import itemgetter
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, replace
+
+
+class LazyImport:
+    # Stands in for a heavy module (or an attribute of one) until it is first
+    # used, then replaces itself in this module's globals so later lookups
+    # cost nothing. Keeps `import census` fast for short-lived processes.
+    def __init__(self, alias, module, attribute=None):
+        self.__alias = alias
+        self.__module = module
+        self.__attribute = attribute
+
+    def __load(self):
+        value = importlib.import_module(self.__module)
+        if self.__attribute is not None:
+            value = getattr(value, self.__attribute)
+        globals()[self.__alias] = value
+        return value
+
+    def __getattr__(self, name):
+        return getattr(self.__load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.__load()(*args, **kwargs)
+
+
+np = LazyImport('np', 'numpy')
+pd = LazyImport('pd', 'pandas')
+requests = LazyImport('requests', 'requests')
+HTTPAdapter = LazyImport('HTTPAdapter', 'requests.adapters', 'HTTPAdapter')
+msg = LazyImport('msg', 'wasabi', 'msg')
+asyncio = LazyImport('asyncio', 'asyncio')
+sqlite3 = LazyImport('sqlite3', 'sqlite3')
+mmap = LazyImport('mmap', 'mmap')
+
+logger = logging.getLogger('census')
+
+# The request cap of the AsyncCensus whose query is running, if any. It is a
+# context variable so it follows the query onto the pool threads it fans out
+# to (see `submit_in_context`) without touching the shared Census object.
+request_slots = contextvars.ContextVar('request_slots', default=None)
+
+
+def submit_in_context(executor, fn, *args):
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class Stats:
+    # Timings, counters and events for everything a Census object does.
+    # `stage(name)` times a block and adds it to per-stage totals; `count`
+    # bumps a counter (bytes, requests, retries, cache hits/misses, ...).
+    # Every stage and event is passed to the registered hooks as a dict, and
+    # also logged to the `census` logger when `log` is true.
+    def __init__(self, log=False):
+        self.log = log
+        self.__lock = threading.Lock()
+        self.__hooks = []
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__timings = {}
+            self.__counters = {}
+
+    def add_hook(self, hook):
+        self.__hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.__hooks.remove(hook)
+
+    def emit(self, event, **fields):
+        if not self.__hooks and not self.log:
+            return
+        record = {'event': event, 'time': time.time(), 'thread': threading.get_ident()}
+        record.update(fields)
+        for hook in list(self.__hooks):
+            # Runs while a stage unwinds, so a failing hook must not abort
+            # the pull or hide its exception.
+            try:
+                hook(record)
+            except Exception:
+                logger.exception(f'Stats hook {hook!r} failed on {event!r}')
+        if self.log:
+            logger.info(dumps(record, default=str))
+
+    def count(self, name, n=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name, **fields):
+        # The yielded dict can be filled in with extra fields (rows, bytes)
+        # that are sent along with the event.
+        start = time.perf_counter()
+        info = dict(fields)
+        try:
+            yield info
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.__lock:
+                timing = self.__timings.setdefault(name, [0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+            self.emit(name, seconds=elapsed, **info)
+
+    def snapshot(self):
+        with self.__lock:
+            stages = {
+                name: {'count': count, 'total': total, 'mean': total / count, 'max': longest}
+                for name, (count, total, longest) in self.__timings.items()
+            }
+            return {'stages': stages, 'counters': dict(self.__counters)}
+
+    def report(self):
+        snapshot = self.snapshot()
+        lines = [f'{"stage":<24}{"count":>10}{"total s":>12}{"mean ms":>12}{"max ms":>12}']
+        for name, t in sorted(snapshot['stages'].items(), key=lambda item: -item[1]['total']):
+            lines.append(f'{name:<24}{t["count"]:>10}{t["total"]:>12.3f}{t["mean"] * 1000:>12.1f}{t["max"] * 1000:>12.1f}')
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{name:<24}{value:>10}')
+        return '\n'.join(lines)
+
+
+def redact(url):
+    return re.sub(r'([?&]key=)[^&]*', r'\1***', url)
+
+
+# Request priorities for the rate limiter: metadata goes before bulk data.
+METADATA = 0
+DATA = 1
+
+
+class Transport:
+    # One pooled, keep-alive HTTP session for every request a Census object
+    # makes. Connection errors, timeouts and the 429/5xx responses the API
+    # sends under load are retried with exponential backoff and full jitter.
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=10, retries=3, backoff=0.5, max_backoff=30, timeout=(10, 120)):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.__session = None
+        self.__lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Created on first use, so constructing a Census object does not
+        # import requests.
+        if self.__session is None:
+            with self.__lock:
+                if self.__session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self.__session = session
+        return self.__session
+
+    def get_delay(self, attempt, response=None):
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return min(self.max_backoff, int(response.headers['Retry-After']))
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, headers=None, stream=False, stats=None, limiter=None, priority=DATA):
+        attempt = 0
+        while True:
+            if limiter is not None:
+                waited = limiter.acquire(priority)
+                if waited and stats is not None:
+                    stats.count('throttled')
+                    stats.emit('throttle', url=redact(url), priority=priority, seconds=waited)
+            try:
+                r = self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.get_delay(attempt)
+                reason = type(e).__name__
+            else:
+                if r.status_code not in self.retry_statuses or attempt >= self.retries:
+                    return r
+                r.close()
+                delay = self.get_delay(attempt, r)
+                reason = r.status_code
+            if stats is not None:
+                stats.count('retries')
+                stats.emit('retry', url=redact(url), attempt=attempt + 1, reason=reason, delay=delay)
+            if limiter is not None and reason == 429:
+                # Everyone sharing the key backs off, not just this thread.
+                limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        if self.__session is not None:
+            self.__session.close()
+
+
+
+class RateLimiter:
+    # Token bucket that spaces out the requests made with one API key:
+    # `rate` requests per second on average, in bursts of up to `burst`.
+    # `shared(key)` returns the one limiter every thread in the process uses
+    # for a key (and file); asking again with another rate or burst changes
+    # it, so the latest setting wins. With `path`, the bucket lives in that file under an fcntl
+    # lock, so worker processes that use the same file share it as well.
+    # fcntl is POSIX-only, so `path` is not supported on Windows.
+    # Metadata requests go first: bulk data waits while one is queued and
+    # leaves the last `reserve` tokens to metadata.
+    __shared = {}
+    __shared_lock = threading.Lock()
+
+    def __init__(self, rate=5, burst=10, reserve=1, path=None):
+        if path is not None and os.name != 'posix':
+            raise ValueError('A file-backed rate limit needs fcntl, which is only available on POSIX.')
+        self.configure(rate, burst, reserve)
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__queue = threading.Condition()
+        self.__waiting = 0
+        self.__bucket = [burst, time.time(), 0.0]
+
+    @classmethod
+    def shared(cls, key, path=None, **kwargs):
+        with cls.__shared_lock:
+            limiter = cls.__shared.get((key, path))
+            if limiter is None:
+                limiter = cls.__shared[(key, path)] = cls(path=path, **kwargs)
+            else:
+                limiter.configure(**kwargs)
+            return limiter
+
+    def configure(self, rate=None, burst=None, reserve=None):
+        # Sets the limits; left-out ones keep their current value.
+        rate = self.rate if rate is None else rate
+        burst = self.burst if burst is None else burst
+        reserve = self.reserve if reserve is None else reserve
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate must be positive and burst at least 1')
+        self.rate = rate
+        self.burst = burst
+        self.reserve = min(reserve, burst - 1)
+
+    @contextmanager
+    def __state(self):
+        # [tokens, updated, paused until], written back when the block exits
+        with self.__lock:
+            if self.path is None:
+                yield self.__bucket
+                return
+            import fcntl
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                fields = f.read().split()
+                state = [float(field) for field in fields] if len(fields) == 3 else [self.burst, time.time(), 0.0]
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(' '.join(map(repr, state)))
+
+    def __take(self, state, priority):
+        # Takes a token and returns 0, or returns how long to wait for one.
+        now = time.time()
+        state[0] = min(self.burst, state[0] + max(0, now - state[1]) * self.rate)
+        state[1] = max(now, state[1])
+        if now < state[2]:
+            return state[2] - now
+        floor = 1 if priority == METADATA else 1 + self.reserve
+        if state[0] < floor:
+            return (floor - state[0]) / self.rate
+        state[0] -= 1
+        return 0
+
+    def acquire(self, priority=DATA):
+        # Blocks until a request may be sent; returns the seconds waited.
+        start = time.time()
+        if priority == METADATA:
+            with self.__queue:
+                self.__waiting += 1
+        try:
+            while True:
+                if priority != METADATA:
+                    with self.__queue:
+                        self.__queue.wait_for(lambda: not self.__waiting)
+                with self.__state() as state:
+                    wait = self.__take(state, priority)
+                if not wait:
+                    return time.time() - start
+                time.sleep(wait)
+        finally:
+            if priority == METADATA:
+                with self.__queue:
+                    self.__waiting -= 1
+                    self.__queue.notify_all()
+
+    def pause(self, seconds):
+        # Called on a 429: nobody sends for `seconds`, then the bucket
+        # refills from empty.
+        with self.__state() as state:
+            until = max(state[2], time.time() + seconds)
+            state[:] = [0, until, until]
+
+
+class ResultStore:
+    # Opt-in SQLite store for parsed data responses. Published vintages do
+    # not change, so a repeated request can be answered from disk. Entries
+    # are keyed by the request URL without the API key, stored as compressed
+    # json, and evicted least recently used once `max_bytes` is exceeded.
+    # `max_age` (seconds) optionally expires old entries.
+    def __init__(self, path='census_results.sqlite', max_bytes=1024 * 1024 * 1024, max_age=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+
+    @staticmethod
+    def normalize(url):
+        parts = urlsplit(url)
+        params = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name != 'key')
+        return parts.path + '?' + urlencode(params, safe=':,*()')
+
+    def get(self, url):
+        key = self.normalize(url)
+        with self.__lock:
+            row = self.__db.execute('SELECT value, created FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.max_age is not None and time.time() - row[1] > self.max_age:
+                self.__db.execute('DELETE FROM results WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self.__db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        return True, loads(zlib.decompress(row[0]))
+
+    def put(self, url, rows):
+        value = zlib.compress(dumps(rows, separators=(',', ':')).encode())
+        now = time.time()
+        with self.__lock:
+            self.__db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', (self.normalize(url), value, len(value), now, now))
+            self.__evict()
+
+    def __evict(self):
+        total = self.__db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        while total > self.max_bytes:
+            row = self.__db.execute('SELECT key, size FROM results ORDER BY accessed LIMIT 1').fetchone()
+            if row is None:
+                break
+            self.__db.execute('DELETE FROM results WHERE key = ?', (row[0],))
+            total -= row[1]
+            self.evictions += 1
+
+    def invalidate(self, url=None, prefix=None):
+        # Drops one URL, every URL under a path prefix such as
+        # '/data/2020/acs/acs5', or everything when called without arguments.
+        with self.__lock:
+            if url is not None:
+                self.__db.execute('DELETE FROM results WHERE key = ?', (self.normalize(url),))
+            elif prefix is not None:
+                self.__db.execute("DELETE FROM results WHERE key LIKE ? ESCAPE '\\'", (prefix.replace('%', '\\%').replace('_', '\\_') + '%',))
+            else:
+                self.__db.execute('DELETE FROM results')
+
+    def stats(self):
+        with self.__lock:
+            entries, size = self.__db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': entries, 'bytes': size}
+
+    def close(self):
+        self.__db.close()
+
+
+def build_variables_frame(variables):
+    # Builds the concept/variable table straight from the `variables` mapping
+    # of variables.json. Each column is a list that is only padded when a
+    # value is written to it, so every cell is touched once.
+    columns = {'concept': [], 'variable': []}
+    n = 0
+    for variable, metadata in variables.items():
+        if 'concept' not in metadata:
+            continue
+        columns['concept'].append(metadata['concept'])
+        columns['variable'].append(variable)
+        for key, value in metadata.items():
+            if key == 'concept':
+                continue
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * n
+            elif len(column) < n:
+                column.extend([None] * (n - len(column)))
+            column.append(value)
+        n += 1
+
+    for column in columns.values():
+        if len(column) < n:
+            column.extend([None] * (n - len(column)))
+
+    df = pd.DataFrame(columns)
+    # Concepts are listed in the order they first appear, same as
+    # `process_variables_and_concepts`.
+    df['concept'] = pd.Categorical(df['concept'], categories=pd.unique(df['concept']))
+    if 'group' in df:
+        df['group'] = df['group'].astype('category')
+    return df.sort_values('concept', kind='stable').reset_index(drop=True)
+
+
+def catalog_records(datasets):
+    # The parts of each data.json entry that the catalog index needs. This is
+    # what the catalog snapshot stores.
+    records = []
+    for dataset in datasets:
+        path = dataset.get('c_dataset', [])
+        if not path:
+            if 'c_vintage' in dataset:
+                raise ValueError(f'No api found for data set {dataset["title"]}')
+            continue
+        distribution = dataset.get('distribution') or [{}]
+        records.append({
+            'year': str(dataset['c_vintage']) if 'c_vintage' in dataset else None,
+            'dataset': list(path),
+            'title': dataset.get('title', ''),
+            'description': dataset.get('description', ''),
+            'keywords': list(dataset.get('keyword', [])),
+            'url': distribution[0].get('accessURL'),
+        })
+    return records
+
+
+class CatalogIndex:
+    # Hash lookups over the data.json catalog: year -> api -> database ->
+    # tables, dataset -> vintages and (year, *dataset) -> record, plus an
+    # inverted token index over titles, descriptions and keywords. Datasets
+    # without a vintage (timeseries) are only found by search.
+    def __init__(self, records):
+        self.records = records
+        self.datasets = {}
+        self.tree = {}
+        self.vintages = {}
+        self.tokens = {}
+
+        for i, record in enumerate(records):
+            year = record['year']
+            path = tuple(record['dataset'])
+            self.datasets[(year,) + path] = record
+            if year is not None:
+                self.vintages.setdefault(path, set()).add(year)
+                databases = self.tree.setdefault(year, {}).setdefault(path[0], {})
+                if len(path) > 1:
+                    tables = databases.setdefault(path[1], {})
+                    if len(path) > 2:
+                        tables[path[2]] = record
+            for token in tokenize(' '.join([record['title'], record['description'], *record['keywords'], *path])):
+                self.tokens.setdefault(token, set()).add(i)
+
+        self.__sorted_tokens = sorted(self.tokens)
+
+    def __len__(self):
+        return len(self.records)
+
+    def years(self):
+        return self.tree.keys()
+
+    def apis(self, year):
+        return self.tree[year].keys()
+
+    def databases(self, year, api):
+        return self.tree[year][api].keys()
+
+    def tables(self, year, api, database):
+        return list(self.tree[year][api][database])
+
+    def has_dataset(self, year, api, database, table='detail'):
+        tables = self.tree.get(str(year), {}).get(api, {}).get(database)
+        if tables is None:
+            return False
+        return table == 'detail' or table in tables
+
+    def get(self, year, *dataset):
+        # The record for one vintage of a dataset, e.g. get(2020, 'acs', 'acs5')
+        return self.datasets.get((None if year is None else str(year),) + dataset)
+
+    def get_vintages(self, *dataset):
+        return sorted(self.vintages.get(dataset, ()), key=int)
+
+    def get_options(self):
+        # The nested year -> api -> database -> [tables] dict
+        return {
+            year: {api: {database: list(tables) for database, tables in databases.items()} for api, databases in apis.items()}
+            for year, apis in self.tree.items()
+        }
+
+    def search(self, query, year=None, limit=None):
+        # Every word of the query has to appear in the title, description,
+        # keywords or path of a dataset. The last word may be a prefix.
+        found = [self.records[i] for i in sorted(match_tokens(self.tokens, self.__sorted_tokens, query))]
+        if year is not None:
+            found = [record for record in found if record['year'] == str(year)]
+        return found[:limit] if limit is not None else found
+
+
+class CatalogCache:
+    # Keeps the catalog records (see `catalog_records`) on disk so a new
+    # Census object does not have to download and walk the whole catalog.
+    # They live in a small json file; the raw catalog is kept next to it
+    # (gzipped) and only read when `get_api_data()` is called.
+    index_file = 'catalog.json'
+    data_file = 'data.json.gz'
+
+    def __init__(self, path=None, ttl=86400):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache', 'census')
+        self.path = path
+        self.ttl = ttl
+
+    def index_path(self):
+        return os.path.join(self.path, self.index_file)
+
+    def data_path(self):
+        return os.path.join(self.path, self.data_file)
+
+    def exists(self):
+        return os.path.exists(self.index_path())
+
+    def load(self):
+        with open(self.index_path()) as f:
+            return loads(f.read())
+
+    def load_data(self):
+        with gzip.open(self.data_path(), 'rt') as f:
+            return loads(f.read())['dataset']
+
+    def is_fresh(self, snapshot):
+        return self.ttl is not None and time.time() - snapshot['fetched'] < self.ttl
+
+    def save(self, raw_text, records, etag=None, last_modified=None):
+        os.makedirs(self.path, exist_ok=True)
+        snapshot = {
+            'fetched': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'catalog': records,
+        }
+        # Write to a temporary file first so that concurrent workers never
+        # read a half-written snapshot.
+        tmp = self.data_path() + f'.{os.getpid()}.tmp'
+        with gzip.open(tmp, 'wt') as f:
+            f.write(raw_text)
+        os.replace(tmp, self.data_path())
+
+        tmp = self.index_path() + f'.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(dumps(snapshot, separators=(',', ':')))
+        os.replace(tmp, self.index_path())
+        return snapshot
+
+    def touch(self, snapshot):
+        snapshot['fetched'] = time.time()
+        tmp = self.index_path() + f'.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(dumps(snapshot, separators=(',', ':')))
+        os.replace(tmp, self.index_path())
+        return snapshot
+
+
+class MetadataCache:
+    # Shared cache for per-table metadata documents (variables.json,
+    # geography.json, ...). Entries are keyed by
+    # (year, api, database, table, endpoint) and evicted least recently used
+    # once `max_bytes` is exceeded. If `path` is given, documents are also
+    # written to disk and read back from there before going to the network.
+    def __init__(self, max_bytes=256 * 1024 * 1024, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+        self.__key_locks = {}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def size(self):
+        return self.__size
+
+    def entry_size(self, key):
+        with self.__lock:
+            if key in self.__entries:
+                return self.__entries[key][1]
+        return None
+
+    def disk_path(self, key):
+        parts = [str(k).replace('/', '_') for k in key]
+        return os.path.join(self.path, *parts[:-1], f'{parts[-1]}.json.gz')
+
+    def __lookup(self, key):
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                return True, self.__entries[key][0]
+        return False, None
+
+    def put(self, key, value, nbytes):
+        with self.__lock:
+            if key in self.__entries:
+                self.__size -= self.__entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self.__entries[key] = (value, nbytes)
+            self.__size += nbytes
+            while self.__size > self.max_bytes:
+                _, (_, evicted) = self.__entries.popitem(last=False)
+                self.__size -= evicted
+
+    def get(self, key, load, persist=True):
+        # `load` returns the raw text of the document. The parsed document is
+        # what gets cached; the text length is used as its size.
+        def build():
+            text = None
+            if persist and self.path is not None and os.path.exists(self.disk_path(key)):
+                with gzip.open(self.disk_path(key), 'rt') as f:
+                    text = f.read()
+            if text is None:
+                text = load()
+                if persist and self.path is not None:
+                    self.__write(key, text)
+            return loads(text), len(text)
+
+        return self.compute(key, build)
+
+    def compute(self, key, build):
+        # `build` returns a (value, size in bytes) pair. It is only called if
+        # the key is not cached, and only by one thread at a time.
+        found, value = self.__lookup(key)
+        if found:
+            return value
+
+        with self.__lock:
+            key_lock = self.__key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            found, value = self.__lookup(key)
+            if found:
+                return value
+            value, nbytes = build()
+            self.put(key, value, nbytes)
+
+        with self.__lock:
+            self.__key_locks.pop(key, None)
+        return value
+
+    def __write(self, key, text):
+        path = self.disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+            with gzip.open(tmp, 'wt') as f:
+                f.write(text)
+            os.replace(tmp, path)
+        except OSError as e:
+            msg.warn(f'Warning: Could not write metadata cache to {path}: {e}')
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+
+
+def prefix_matches(tokens, sorted_tokens, prefix):
+    matches = set()
+    i = bisect_left(sorted_tokens, prefix)
+    while i < len(sorted_tokens) and sorted_tokens[i].startswith(prefix):
+        matches |= tokens[sorted_tokens[i]]
+        i += 1
+    return matches
+
+
+def match_tokens(tokens, sorted_tokens, query):
+    # Entries of an inverted index that have every word of the query. The
+    # last word may be a prefix.
+    words = tokenize(query)
+    if not words:
+        return set()
+    matches = None
+    for i, word in enumerate(words):
+        if i == len(words) - 1:
+            found = prefix_matches(tokens, sorted_tokens, word)
+        else:
+            found = tokens.get(word, set())
+        matches = found if matches is None else matches & found
+        if not matches:
+            return set()
+    return matches
+
+
+class MetadataIndex:
+    # Hash lookups over one variables.json document: variable -> metadata,
+    # concept -> variables and group -> variables, plus an inverted token
+    # index over labels and concepts for searching.
+    def __init__(self, variables):
+        self.variables = {}
+        self.concepts = {}
+        self.groups = {}
+        self.tokens = {}
+
+        for variable, metadata in variables.items():
+            if 'concept' not in metadata:
+                continue
+            self.variables[variable] = metadata
+            self.concepts.setdefault(metadata['concept'], []).append(variable)
+            if 'group' in metadata:
+                self.groups.setdefault(metadata['group'], []).append(variable)
+            for token in tokenize(metadata.get('label', '') + ' ' + metadata['concept'] + ' ' + variable):
+                self.tokens.setdefault(token, set()).add(variable)
+
+        self.__sorted_tokens = sorted(self.tokens)
+
+    def __contains__(self, variable):
+        return variable in self.variables
+
+    def __len__(self):
+        return len(self.variables)
+
+    def get_label(self, variable, default=None):
+        metadata = self.variables.get(variable)
+        if metadata is None:
+            return default
+        return metadata.get('label', default)
+
+    def prefix_matches(self, prefix):
+        return prefix_matches(self.tokens, self.__sorted_tokens, prefix)
+
+    def search(self, query, limit=None):
+        # Every word of the query has to appear in the label, concept or
+        # name of a variable. The last word may be a prefix.
+        result = sorted(match_tokens(self.tokens, self.__sorted_tokens, query))
+        return result[:limit] if limit is not None else result
+
+
+### METADATA BUNDLES
+# A bundle holds the variables, geography and groups documents of many
+# tables in one file that is read through mmap, so it loads in no time and
+# its pages are shared by every process that opens it. Layout, in native
+# byte order:
+#
+#   b'CENSUSMB', header length (uint64), header (json), padding to 8
+#   string offsets (uint64 x count + 1), string data (utf-8)
+#   per table: variable rows (uint32 x 8 per variable, grouped by concept)
+#              concepts (uint32 x 3 per concept: string, first row, end row)
+#
+# The header maps 'year/api/database/table' to the position of its rows and
+# concepts, relative to the end of the header, and to the string ids of its
+# geography and groups documents.
+BUNDLE_MAGIC = b'CENSUSMB'
+BUNDLE_FIELDS = ('name', 'label', 'concept', 'predicateType', 'group', 'limit', 'attributes', 'extra')
+NO_VALUE = 0xFFFFFFFF
+
+
+def bundle_key(year, api, database, table):
+    return '/'.join([str(year), api, database, table])
+
+
+def write_metadata_bundle(path, documents):
+    # `documents` maps (year, api, database, table) to a dict with the
+    # parsed 'variables', 'geography' and 'groups' documents (any may be
+    # missing).
+    strings = {}
+
+    def intern(value):
+        if value is None:
+            return NO_VALUE
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    tables = {}
+    for dataset, docs in documents.items():
+        concepts = {}
+        for name, metadata in docs.get('variables', {}).get('variables', {}).items():
+            concepts.setdefault(metadata.get('concept'), []).append((name, metadata))
+        # Variables without a concept (predicates like `for`) go last.
+        if None in concepts:
+            concepts[None] = concepts.pop(None)
+        rows = array('I')
+        ranges = array('I')
+        for concept, variables in concepts.items():
+            start = len(rows) // len(BUNDLE_FIELDS)
+            for name, metadata in variables:
+                extra = {k: v for k, v in metadata.items() if k not in BUNDLE_FIELDS}
+                limit = metadata.get('limit')
+                rows.extend([
+                    intern(name), intern(metadata.get('label')), intern(concept), intern(metadata.get('predicateType')),
+                    intern(metadata.get('group')), limit if isinstance(limit, int) and 0 <= limit < NO_VALUE else NO_VALUE,
+                    intern(metadata.get('attributes')), intern(dumps(extra)) if extra else NO_VALUE,
+                ])
+            if concept is not None:
+                ranges.extend([intern(concept), start, len(rows) // len(BUNDLE_FIELDS)])
+        tables[bundle_key(*dataset)] = {
+            'rows': rows,
+            'concepts': ranges,
+            'geography': intern(dumps(docs['geography'])) if 'geography' in docs else None,
+            'groups': intern(dumps(docs['groups'])) if 'groups' in docs else None,
+            'has_variables': 'variables' in docs,
+        }
+
+    encoded = [value.encode() for value in strings]
+    offsets = array('Q', [0])
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    data = b''.join(encoded)
+
+    def padded(n):
+        return (n + 7) // 8 * 8
+
+    position = 0
+    sections = []
+    header = {'version': 1, 'byteorder': sys.byteorder, 'strings': [position, len(encoded)], 'tables': {}}
+    sections.append(offsets.tobytes())
+    position = padded(position + len(sections[-1]))
+    header['data'] = [position, len(data)]
+    sections.append(data)
+    position = padded(position + len(data))
+    for key, table in tables.items():
+        entry = {'geography': table['geography'], 'groups': table['groups']}
+        if table['has_variables']:
+            entry['rows'] = [position, len(table['rows']) // len(BUNDLE_FIELDS)]
+            sections.append(table['rows'].tobytes())
+            position = padded(position + len(sections[-1]))
+            entry['concepts'] = [position, len(table['concepts']) // 3]
+            sections.append(table['concepts'].tobytes())
+            position = padded(position + len(sections[-1]))
+        header['tables'][key] = entry
+
+    header = dumps(header, separators=(',', ':')).encode()
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(BUNDLE_MAGIC + len(header).to_bytes(8, 'little') + header)
+        f.write(b'\0' * (padded(f.tell()) - f.tell()))
+        for section in sections:
+            f.write(section)
+            f.write(b'\0' * (padded(len(section)) - len(section)))
+    os.replace(tmp, path)
+    return path
+
+
+class MetadataBundle:
+    # Read-only view of a file written by `write_metadata_bundle`. Strings
+    # are only decoded when they are asked for.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.__mmap)
+        if bytes(view[:8]) != BUNDLE_MAGIC:
+            raise ValueError(f'{path} is not a metadata bundle.')
+        length = int.from_bytes(view[8:16], 'little')
+        self.__header = loads(bytes(view[16:16 + length]))
+        if self.__header['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a machine with a different byte order.')
+        base = (16 + length + 7) // 8 * 8
+        self.__view = view[base:]
+        position, count = self.__header['strings']
+        self.__offsets = self.__view[position:position + 8 * (count + 1)].cast('Q')
+        position, size = self.__header['data']
+        self.__data = self.__view[position:position + size]
+        self.__data_start = base + position
+
+    def __contains__(self, dataset):
+        return bundle_key(*dataset) in self.__header['tables']
+
+    def datasets(self):
+        return [tuple(key.split('/')) for key in self.__header['tables']]
+
+    def has(self, year, api, database, table, endpoint='variables'):
+        entry = self.__header['tables'].get(bundle_key(year, api, database, table))
+        if entry is None:
+            return False
+        return 'rows' in entry if endpoint == 'variables' else entry.get(endpoint) is not None
+
+    def string(self, i):
+        if i == NO_VALUE:
+            return None
+        return str(self.__data[self.__offsets[i]:self.__offsets[i + 1]], 'utf-8')
+
+    def __array(self, span, width):
+        position, count = span
+        return self.__view[position:position + 4 * width * count].cast('I')
+
+    def __rows(self, entry):
+        return self.__array(entry['rows'], len(BUNDLE_FIELDS))
+
+    def __concepts(self, entry):
+        concepts = self.__array(entry['concepts'], 3)
+        return [(concepts[i], concepts[i + 1], concepts[i + 2]) for i in range(0, len(concepts), 3)]
+
+    def __entry(self, year, api, database, table):
+        entry = self.__header['tables'].get(bundle_key(year, api, database, table))
+        if entry is None or 'rows' not in entry:
+            raise ValueError(f'No variables for {bundle_key(year, api, database, table)} in {self.path}.')
+        return entry
+
+    def __variables(self, rows, start, end):
+        # Yields (name, metadata) for rows start..end. Strings that repeat
+        # across rows (concepts, groups, predicate types) are decoded once.
+        width = len(BUNDLE_FIELDS)
+        values = rows[start * width:end * width].tolist()
+        # A list indexes faster than the mmap'd array, once it pays for itself.
+        offsets = self.__offsets.tolist() if end - start > 1000 else self.__offsets
+        data = self.__mmap
+        base = self.__data_start
+        decoded = {NO_VALUE: None}
+
+        def string(i):
+            return data[base + offsets[i]:base + offsets[i + 1]].decode()
+
+        def shared(i):
+            if i not in decoded:
+                decoded[i] = string(i)
+            return decoded[i]
+
+        for i in range(0, len(values), width):
+            name, label, concept, predicate, group, limit, attributes, extra = values[i:i + width]
+            metadata = {}
+            if label != NO_VALUE:
+                metadata['label'] = string(label)
+            if concept != NO_VALUE:
+                metadata['concept'] = shared(concept)
+            if predicate != NO_VALUE:
+                metadata['predicateType'] = shared(predicate)
+            if group != NO_VALUE:
+                metadata['group'] = shared(group)
+            if limit != NO_VALUE:
+                metadata['limit'] = limit
+            if attributes != NO_VALUE:
+                metadata['attributes'] = string(attributes)
+            if extra != NO_VALUE:
+                metadata.update(loads(string(extra)))
+            yield string(name), metadata
+
+    def concepts(self, year, api, database, table):
+        return [self.string(concept) for concept, _, _ in self.__concepts(self.__entry(year, api, database, table))]
+
+    def variable_names(self, year, api, database, table, concepts=None):
+        # In the order of `concepts`, like `MetadataIndex.concepts`.
+        entry = self.__entry(year, api, database, table)
+        rows = self.__rows(entry)
+        width = len(BUNDLE_FIELDS)
+        spans = {self.string(concept): (start, end) for concept, start, end in self.__concepts(entry)}
+        names = []
+        for concept in spans if concepts is None else concepts:
+            start, end = spans.get(concept, (0, 0))
+            names += [self.string(rows[i * width]) for i in range(start, end)]
+        return names
+
+    def concepts_and_variables(self, year, api, database, table, concepts=None):
+        # Same shape as `Census.process_variables_and_concepts`, decoding only
+        # the rows of the requested concepts.
+        entry = self.__entry(year, api, database, table)
+        rows = self.__rows(entry)
+        wanted = None if concepts is None else set(concepts)
+        result = {}
+        for concept, start, end in self.__concepts(entry):
+            concept = self.string(concept)
+            if wanted is not None and concept not in wanted:
+                continue
+            result[concept] = []
+            for name, metadata in self.__variables(rows, start, end):
+                del metadata['concept']
+                result[concept].append(dict({'variable': name}, **metadata))
+        return result
+
+    def document(self, year, api, database, table, endpoint):
+        # The parsed document, as `Census.pull_metadata` returns it, and the
+        # number of bytes of text it was rebuilt from.
+        if endpoint != 'variables':
+            entry = self.__header['tables'][bundle_key(year, api, database, table)]
+            text = self.string(entry[endpoint])
+            return loads(text), len(text)
+        entry = self.__entry(year, api, database, table)
+        rows = self.__rows(entry)
+        variables = dict(self.__variables(rows, 0, entry['rows'][1]))
+        # Sized as rows x fields x the average string, about the json text.
+        average = len(self.__data) // max(1, len(self.__offsets) - 1)
+        return {'variables': variables}, average * len(BUNDLE_FIELDS) * entry['rows'][1]
+
+    def close(self):
+        self.__offsets.release()
+        self.__data.release()
+        self.__view.release()
+        self.__mmap.close()
+
+def merge_chunks(results, widths):
+    # Joins the responses of a chunked pull. Each response has its chunk's
+    # variables first and the geography columns after them; rows are matched
+    # on the geography columns with a dict, in the row order of the first
+    # response.
+    first, *rest = results
+    geography_columns = first[0][widths[0]:]
+    header = [column for result, width in zip(results, widths) for column in result[0][:width]] + geography_columns
+
+    lookups = []
+    for result, width in zip(rest, widths[1:]):
+        lookups.append({tuple(row[width:]): row[:width] for row in result[1:]})
+
+    rows = [header]
+    for row in first[1:]:
+        key = tuple(row[widths[0]:])
+        merged = row[:widths[0]]
+        for lookup, width in zip(lookups, widths[1:]):
+            merged = merged + lookup.get(key, [None] * width)
+        rows.append(merged + row[widths[0]:])
+    return rows
+
+
+# Values the API uses in place of an estimate, e.g. -666666666 when the
+# sample is too small. They are turned into NaN when decoding.
+SENTINELS = (-999999999, -888888888, -666666666, -555555555, -333333333, -222222222)
+NUMERIC_TYPES = ('int', 'float')
+
+
+def decode_column(values, predicate_type=None):
+    if predicate_type not in NUMERIC_TYPES:
+        return values
+    numbers = pd.to_numeric(values, errors='coerce')
+    missing = np.isin(numbers, SENTINELS)
+    if predicate_type == 'int' and not missing.any() and numbers.dtype.kind == 'i':
+        return numbers.astype(np.int64, copy=False)
+    numbers = numbers.astype(np.float64)
+    numbers[missing] = np.nan
+    return numbers
+
+
+def decode_rows(rows, types=None, start=1):
+    # Turns the API's array-of-arrays response (header row first) into a
+    # DataFrame. Each column is read straight out of the parsed rows and
+    # decoded before the next one, so only one raw column is held at a time
+    # instead of a copy of the whole body.
+    # Columns whose `predicateType` is int or float become int64 or float64.
+    if not rows:
+        return pd.DataFrame()
+    header = rows[0]
+    n = len(rows) - 1
+    types = types or {}
+    columns = {}
+    for j, name in enumerate(header):
+        values = np.fromiter(map(itemgetter(j), islice(rows, 1, None)), dtype=object, count=n)
+        columns[name] = decode_column(values, types.get(name))
+    return pd.DataFrame(columns, index=pd.RangeIndex(start, start + n), copy=False)
+
+
+ESTIMATE_COLUMN = re.compile(r'_\d+P?E$')
+
+
+def frame_memory(df):
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+def smallest_int(low, high):
+    for dtype in ('int8', 'int16', 'int32'):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return 'int64'
+
+
+def compact_column(values):
+    # Smallest dtype that holds the column exactly: integers shrink to
+    # int8/16/32, floats that are whole numbers become nullable integers,
+    # other floats become float32 if that round-trips, and repetitive strings
+    # (geography codes, county names) become categoricals.
+    if pd.api.types.is_bool_dtype(values) or len(values) == 0:
+        return values
+    if pd.api.types.is_numeric_dtype(values):
+        data = values.to_numpy()
+        if values.dtype.kind in 'iu':
+            return values.astype(smallest_int(data.min(), data.max()))
+        if values.dtype.kind != 'f':
+            return values
+        present = data[~np.isnan(data)]
+        if not len(present):
+            return values
+        if np.all(present == np.round(present)) and np.abs(present).max() < 2 ** 53:
+            return values.astype(smallest_int(present.min(), present.max()).capitalize())
+        single = data.astype(np.float32)
+        if np.array_equal(single.astype(np.float64), data, equal_nan=True):
+            return pd.Series(single, index=values.index, name=values.name)
+        return values
+    if values.nunique(dropna=False) <= len(values) // 2:
+        return values.astype('category')
+    return values
+
+
+def compact_frame(df, pairs=True):
+    # Memory-compact copy of a decoded result (see `compact_column`). With
+    # `pairs`, each estimate (B01001_001E) and its margin of error
+    # (B01001_001M) share one dtype and sit under one name in a two-level
+    # column index, so df['B01001_001'] has both. The deep memory use before
+    # and after is kept in df.attrs['memory'].
+    # Columns are read by position, so repeated names each keep their own.
+    positions = {name: j for j, name in enumerate(df.columns)}
+    paired = {name[:-1] for name in positions if ESTIMATE_COLUMN.search(name) and name[:-1] + 'M' in positions} if pairs else set()
+    keys = []
+    columns = []
+    for j, name in enumerate(df.columns):
+        base = name[:-1]
+        if base in paired:
+            if name[-1] == 'E':
+                estimate = df.iloc[:, j]
+                moe = df.iloc[:, positions[base + 'M']]
+                both = compact_column(pd.concat([estimate, moe], ignore_index=True))
+                keys += [(base, 'E'), (base, 'M')]
+                columns += [estimate.astype(both.dtype), moe.astype(both.dtype)]
+        else:
+            keys.append((name, '') if paired else name)
+            columns.append(compact_column(df.iloc[:, j]))
+    compact = pd.DataFrame(dict(enumerate(columns)), index=df.index, copy=False)
+    compact.columns = pd.MultiIndex.from_tuples(keys) if paired else pd.Index(keys)
+    compact.attrs = dict(df.attrs, memory={'before': frame_memory(df), 'after': frame_memory(compact)})
+    return compact
+
+def iter_rows(chunks):
+    # Incrementally parses an array-of-arrays JSON response from an iterable
+    # of byte chunks, yielding each inner array as soon as it is complete.
+    decoder = JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f'Expected a JSON array, got {buffer[pos:pos + 100]!r}')
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                row, pos = decoder.raw_decode(buffer, pos)
+            except JSONDecodeError:
+                # The row is not complete yet; wait for more data.
+                break
+            yield row
+    raise ValueError('Response ended before the end of the JSON array.')
+
+
+def label_geography(df, geography, names):
+    # Replaces geography codes with names in one hashed lookup over all
+    # rows. `names` is indexed by the geography columns; codes without a
+    # name are left as they are.
+    keys = list(names.index.names)
+    if len(keys) > 1:
+        lookup = pd.MultiIndex.from_frame(df[keys].astype(str))
+    else:
+        lookup = pd.Index(df[keys[0]].astype(str))
+    positions = names.index.get_indexer(lookup)
+    labelled = names.to_numpy(dtype=object)[positions]
+    codes = df[geography].to_numpy(dtype=object)
+    return np.where(positions >= 0, labelled, codes)
+
+
+ANNOTATION_COLUMN = re.compile(r'_\d+[A-Z]*[EM]A$')
+MOE_COLUMN = re.compile(r'_\d+P?M$')
+
+
+def get_kept_columns(header, annotations=True, moe=True):
+    # Indexes of the columns to keep, or None to keep all of them.
+    if annotations and moe:
+        return None
+    return [i for i, column in enumerate(header)
+            if not (not annotations and ANNOTATION_COLUMN.search(column)) and not (not moe and MOE_COLUMN.search(column))]
+
+
+def select_columns(rows, annotations=True, moe=True):
+    keep = get_kept_columns(rows[0], annotations, moe) if rows else None
+    if keep is None:
+        return rows
+    return list(project_rows(rows, keep))
+
+
+def project_rows(rows, keep):
+    for row in rows:
+        yield [row[i] for i in keep]
+
+
+def count_data_columns(header, levels):
+    # The API puts the geography columns last.
+    n = len(header)
+    while n and header[n - 1] in levels:
+        n -= 1
+    return n
+
+
+def normalize_geography_values(values):
+    if isinstance(values, (list, tuple, set)):
+        return ','.join(str(value) for value in values)
+    return str(values)
+
+
+def get_in_clause(parents):
+    if not parents:
+        return ''
+    return ''.join(f'&in={level}:{values}' for level, values in parents.items())
+
+
+def tokenize(text):
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+@dataclass(frozen=True)
+class CensusQuery:
+    # Everything needed to run one pull, as an immutable and hashable value.
+    # Lists and dicts passed in are stored as tuples, so queries can be
+    # shared between threads and used as cache keys. Run one with
+    # `Census.execute(query)`.
+    year: str
+    api: str
+    database: str
+    table: str
+    variables: tuple
+    geography: str
+    geography_values: tuple = ('*',)
+    parents: tuple = ()
+    filters: tuple = ()
+    groups: tuple = ()
+    # Keep annotation (e.g. B01001_001EA) and margin of error columns
+    annotations: bool = True
+    moe: bool = True
+
+    def __post_init__(self):
+        object.__setattr__(self, 'year', str(self.year))
+        object.__setattr__(self, 'variables', to_items(self.variables))
+        object.__setattr__(self, 'geography_values', tuple(str(v) for v in to_items(self.geography_values)))
+        object.__setattr__(self, 'parents', to_pairs(self.parents))
+        object.__setattr__(self, 'filters', to_pairs(self.filters))
+        object.__setattr__(self, 'groups', to_items(self.groups))
+
+    def replace(self, **changes):
+        return replace(self, **changes)
+
+    def get_parents(self):
+        return dict(self.parents)
+
+    def get_items(self):
+        # What goes in `get=`: each group as group(...), then the variables.
+        return [f'group({group})' for group in self.groups] + list(self.variables)
+
+    def get_chunks(self, size):
+        # A group expands to many variables on the server, so each one gets
+        # a request of its own.
+        chunks = [[f'group({group})'] for group in self.groups]
+        return chunks + [list(self.variables[i:i + size]) for i in range(0, len(self.variables), size)]
+
+
+def query_id(query):
+    # Short stable name for a query, used in file names.
+    return format(zlib.crc32(repr(query).encode()), '08x')
+
+
+def to_items(values):
+    # A single string or number is one item, not a sequence of characters.
+    if isinstance(values, (str, int)):
+        return (values,)
+    return tuple(values)
+
+
+def to_pairs(mapping):
+    if isinstance(mapping, dict):
+        mapping = mapping.items()
+    return tuple((str(name), normalize_geography_values(value)) for name, value in mapping)
+
+
+default_metadata_cache = MetadataCache()
+
 
 class Census:
     base_url = "https://api.census.gov/data"
+    catalog_url = "https://api.census.gov/data.json"
+    # Most variables the API returns for a single request
+    max_variables = 50
+    # Extra attempts for a request that fails part way through a fan-out
+    shard_retries = 2
     
-    def __init__(self, token):       
+    def __init__(self, token, cache_dir=None, cache_ttl=86400, offline=False, use_cache=True, metadata_cache=None, max_workers=8, transport=None, base_url=None, result_store=None, stats=None, rate_limit=None, validate=True, bundle=None):       
+        self.stats = stats if stats is not None else Stats()
+        if base_url is not None:
+            self.base_url = base_url.rstrip('/')
+            self.catalog_url = self.base_url + '.json'
+        self.__transport = transport if transport is not None else Transport(pool_size=max(10, max_workers))
+        # A number is requests per second for this key, shared by every
+        # Census object in the process that uses it.
+        if isinstance(rate_limit, (int, float)):
+            rate_limit = RateLimiter.shared(token, rate=rate_limit, burst=max(1, int(rate_limit * 2)))
+        self.__rate_limiter = rate_limit
+        # Caps the requests in flight across all threads; see set_max_requests.
+        self.__request_slots = None
+        self.max_requests = None
+
         ####  PRE LOAD INFORMATION  ####
-        # API Data
-        self.__api_raw_data = loads(requests.get('https://api.census.gov/data.json').text)
-        self.__api_data = self.__api_raw_data['dataset']
-        
-        self.__api_options = {}
+        # API Data. The catalog is only loaded once something needs it, and
+        # with `validate=False` the setters trust their arguments and never do.
+        self.__api_data = None
+        self.__catalog = None
+        self.__catalog_lock = threading.Lock()
+        self.__offline = offline
+        self.validate = validate
+        self.__catalog_cache = CatalogCache(cache_dir, cache_ttl) if use_cache or offline else None
 
-        for dataset in self.__api_data:
-            if 'c_vintage' in dataset:
-                year = str(dataset['c_vintage'])
-                if year not in self.__api_options:
-                    self.__api_options[year] = {}
-
-                if len(dataset['c_dataset']) < 1:
-                    raise ValueError(f'No api found for data set {dataset["title"]}')
-                
-                api = dataset['c_dataset'][0]
-                if api not in self.__api_options[year].keys():
-                    self.__api_options[year][api] = {}
-                
-                # Get database in API
-                if len(dataset['c_dataset']) < 2:
-                    pass
-                else:
-                    database = dataset['c_dataset'][1]
-                    if database not in self.__api_options[year][api].keys():
-                        self.__api_options[year][api][database] = []
-                
-                # Get table in database
-                if len(dataset['c_dataset']) < 3:
-                    pass
-                else:
-                    table = dataset['c_dataset'][2]
-                    if table not in self.__api_options[year][api][database]:
-                        self.__api_options[year][api][database].append(table)
+        if offline and not self.__catalog_cache.exists():
+            raise ValueError(f'No catalog snapshot found in {self.__catalog_cache.path}. Create one while online by calling `refresh_catalog()`, or anything that loads the catalog such as `pull_years()`.')
     
         self.__token = token
+        self.__metadata_cache = metadata_cache if metadata_cache is not None else default_metadata_cache
+        self.max_workers = max_workers
+        self.__column_options = {}
+        self.__result_store = result_store
+        # Tables in the bundle are answered from it instead of the API.
+        self.__bundle = MetadataBundle(os.fspath(bundle)) if isinstance(bundle, (str, os.PathLike)) else bundle
+
+    def __get_catalog(self):
+        if self.__catalog is None:
+            with self.__catalog_lock:
+                if self.__catalog is None:
+                    self.__catalog = self.__open_catalog()
+        return self.__catalog
+
+    def __open_catalog(self):
+        if self.__catalog_cache is not None and self.__catalog_cache.exists():
+            snapshot = self.__catalog_cache.load()
+        else:
+            snapshot = None
+
+        with self.stats.stage('catalog') as info:
+            if snapshot is not None and 'catalog' not in snapshot:
+                # Written by an older version, without the catalog records.
+                if self.__offline:
+                    info['source'] = 'cache'
+                    return CatalogIndex(catalog_records(self.get_api_data()))
+                snapshot = None
+            if self.__offline or (snapshot is not None and self.__catalog_cache.is_fresh(snapshot)):
+                info['source'] = 'cache'
+                return CatalogIndex(snapshot['catalog'])
+            info['source'] = 'network'
+            if snapshot is None:
+                return self.__load_catalog()
+            try:
+                return self.__load_catalog(snapshot)
+            except (ValueError, requests.RequestException) as e:
+                # A stale catalog beats none when the API is unreachable.
+                msg.warn(f'Warning: Could not refresh the catalog, using the snapshot in {self.__catalog_cache.path}: {e}')
+                info['source'] = 'stale cache'
+                return CatalogIndex(snapshot['catalog'])
+
+    def __load_catalog(self, snapshot=None):
+        headers = {}
+        if snapshot is not None:
+            if snapshot.get('etag'):
+                headers['If-None-Match'] = snapshot['etag']
+            if snapshot.get('last_modified'):
+                headers['If-Modified-Since'] = snapshot['last_modified']
+
+        r = self.__transport.get(self.catalog_url, headers=headers, stats=self.stats, limiter=self.__rate_limiter, priority=METADATA)
+        if r.status_code == 304 and snapshot is not None:
+            self.__catalog_cache.touch(snapshot)
+            return CatalogIndex(snapshot['catalog'])
+        r.raise_for_status()
+
+        self.__api_data = loads(r.text)['dataset']
+        records = catalog_records(self.__api_data)
+        if self.__catalog_cache is not None:
+            try:
+                self.__catalog_cache.save(r.text, records, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+            except OSError as e:
+                msg.warn(f'Warning: Could not write catalog cache to {self.__catalog_cache.path}: {e}')
+        return CatalogIndex(records)
+
+    def get_transport(self):
+        return self.__transport
+
+    def get_stats(self):
+        return self.stats
+
+    def get_rate_limiter(self):
+        return self.__rate_limiter
+
+    def set_max_requests(self, max_requests=None):
+        # At most `max_requests` requests are sent at once, however many
+        # threads ask; None lifts the cap.
+        self.max_requests = max_requests
+        self.__request_slots = threading.BoundedSemaphore(max_requests) if max_requests else None
+
+    def request(self, url, headers=None, stream=False, priority=METADATA):
+        with self.__request_slots or nullcontext(), request_slots.get() or nullcontext(), self.stats.stage('http', url=redact(url)) as info:
+            r = self.__transport.get(url, headers=headers, stream=stream, stats=self.stats, limiter=self.__rate_limiter, priority=priority)
+            info['status'] = r.status_code
+            self.stats.count('requests')
+            if not stream:
+                info['bytes'] = len(r.content)
+                self.stats.count('bytes', len(r.content))
+        # 204 is how the API says a query matched no rows.
+        if r.status_code not in (200, 204):
+            raise ValueError(f'The Census API returned {r.status_code} for {redact(url)}: {r.text[:500]}')
+        return r
+
+    def refresh_catalog(self):
+        self.__catalog = self.__load_catalog()
 
     def info(self):
         print("This object facilitates the access of U.S. Census data.")
@@ -63,28 +1464,53 @@ class Census:
     
     # API DATA
     def get_api_data(self):
+        if self.__api_data is None:
+            if self.__catalog_cache is not None and os.path.exists(self.__catalog_cache.data_path()):
+                self.__api_data = self.__catalog_cache.load_data()
+            else:
+                self.__api_data = loads(self.request(self.catalog_url).text)['dataset']
         return self.__api_data
     
     def get_api_options(self):
-        return self.__api_options
+        return self.__get_catalog().get_options()
+
+    def get_catalog_index(self):
+        return self.__get_catalog()
     
     def pull_years(self):
-        return self.__api_options.keys()
+        return self.__get_catalog().years()
     
     def pull_apis(self):
-        year = self.get_year()
-        return self.__api_options[year].keys()
+        return self.__get_catalog().apis(self.get_year())
         
     def pull_databases(self):
-        year = self.get_year()
-        api = self.get_api()
-        return self.__api_options[year][api].keys()
+        return self.__get_catalog().databases(self.get_year(), self.get_api())
     
     def pull_tables(self):
-        year = self.get_year()
-        api = self.get_api()
-        database = self.get_database()
-        return self.__api_options[year][api][database]
+        return self.__get_catalog().tables(self.get_year(), self.get_api(), self.get_database())
+
+    def has_dataset(self, year, api, database, table):
+        return self.__get_catalog().has_dataset(year, api, database, table)
+
+    def pull_vintages(self, api=None, database=None, table='detail'):
+        # Every year a dataset is published for, e.g.
+        # pull_vintages('acs', 'acs5', 'subject'). Without arguments, the
+        # current api, database and table.
+        if api is None:
+            api, database, table = self.get_api(), self.get_database(), self.get_table()
+        dataset = [api] + ([database] if database else []) + ([table] if table and table != 'detail' else [])
+        return self.__get_catalog().get_vintages(*dataset)
+
+    def search_datasets(self, query, year=None, as_dataframe=False, limit=None):
+        found = self.__get_catalog().search(query, year, limit)
+        if as_dataframe:
+            return pd.DataFrame({
+                'year': [record['year'] for record in found],
+                'dataset': ['/'.join(record['dataset']) for record in found],
+                'title': [record['title'] for record in found],
+                'url': [record['url'] for record in found],
+            })
+        return found
     
     
     ### YEARS
@@ -98,8 +1524,10 @@ class Census:
             del self.__geography
         except:
             pass
+        self.__groups = ()
+        self.__column_options = {}
 
-        if str(year) in self.pull_years():
+        if not self.validate or str(year) in self.pull_years():
             self.__year = str(year)
         else:
             raise ValueError(f'Not a valid year. Must be one of the following: {self.pull_years()}')
@@ -121,8 +1549,10 @@ class Census:
             del self.__geography
         except:
             pass
+        self.__groups = ()
+        self.__column_options = {}
 
-        if api in self.pull_apis():
+        if not self.validate or api in self.pull_apis():
             self.__api = api
         else:
             raise ValueError(f'API value not found. Supported API\'s for the year {self.get_year()} are {self.pull_apis()}.')
@@ -143,8 +1573,10 @@ class Census:
             del self.__geography
         except:
             pass
+        self.__groups = ()
+        self.__column_options = {}
 
-        if database in self.pull_databases():
+        if not self.validate or database in self.pull_databases():
             self.__database = database
         else:
             raise ValueError(f"Database value not valid. Supported databases for the year {self.get_year()} and the API {self.get_api()} are {self.pull_databases()}.")
@@ -164,10 +1596,12 @@ class Census:
             del self.__geography
         except:
             pass
+        self.__groups = ()
+        self.__column_options = {}
 
-        if table in self.pull_tables() or table == 'detail':
+        if not self.validate or self.has_dataset(self.get_year(), self.get_api(), self.get_database(), table):
             self.__table = table
-            if table == 'detail':
+            if table == 'detail' and self.validate:
                 msg.warn(f'Warning: The `detail` table may or may not exist in the database {self.get_database()}.')
         else:
             raise ValueError(f"Table not valid. Supported tables for the year {self.get_year()} and the API {self.get_api()} in the database {self.get_database()} are {self.pull_tables()}.")
@@ -187,10 +1621,70 @@ class Census:
                 return self.base_url + '/' + '/'.join([year, api, database, table]) + f'/{endpoint}.{extension}'
 
 
+    ### METADATA
+    def get_metadata_cache(self):
+        return self.__metadata_cache
+
+    def get_bundle(self):
+        return self.__bundle
+
+    def __bundled(self, year, api, database, table, endpoint='variables'):
+        return self.__bundle is not None and self.__bundle.has(year, api, database, table, endpoint)
+
+    def pull_metadata(self, year, api, database, table, endpoint):
+        if self.__bundled(year, api, database, table, endpoint):
+            return self.__metadata_cache.compute((year, api, database, table, endpoint), lambda: self.__bundle.document(year, api, database, table, endpoint))
+        link = self.get_link(year, api, database, table, endpoint, 'json')
+        return self.__cached((year, api, database, table, endpoint), lambda: self.request(link).text)
+
+    def __cached(self, key, load):
+        loaded = []
+
+        def fetch():
+            loaded.append(True)
+            return load()
+
+        value = self.__metadata_cache.get(key, fetch)
+        self.stats.count('metadata_cache_misses' if loaded else 'metadata_cache_hits')
+        return value
+
+    def pull_index(self, year=None, api=None, database=None, table=None):
+        year = year or self.get_year()
+        api = api or self.get_api()
+        database = database or self.get_database()
+        table = table or self.get_table()
+
+        def build():
+            cache_key = (year, api, database, table, 'variables')
+            variables = self.pull_metadata(year, api, database, table, 'variables')['variables']
+            # The index is about as large as the document it was built from.
+            nbytes = self.__metadata_cache.entry_size(cache_key) or 0
+            with self.stats.stage('index', table='/'.join([year, api, database, table])) as info:
+                index = MetadataIndex(variables)
+                info['variables'] = len(index)
+            return index, nbytes
+
+        return self.__metadata_cache.compute((year, api, database, table, 'variables-index'), build)
+
+    def search_variables(self, query, as_dataframe=False, limit=None):
+        index = self.pull_index()
+        found = index.search(query, limit)
+        if as_dataframe:
+            return pd.DataFrame({
+                'variable': found,
+                'label': [index.variables[v].get('label') for v in found],
+                'concept': [index.variables[v]['concept'] for v in found],
+                'group': [index.variables[v].get('group') for v in found],
+            })
+        return found
+
+
     ### CONCEPT
     # This function is a helper function
     def process_variables_and_concepts(self, year, api, database, table):
-        variables = loads(requests.get(self.get_link(year, api, database, table, 'variables', 'json')).text)
+        if self.__bundled(year, api, database, table):
+            return self.__bundle.concepts_and_variables(year, api, database, table)
+        variables = self.pull_metadata(year, api, database, table, 'variables')
 
 
         concepts = {}
@@ -215,7 +1709,9 @@ class Census:
         api = self.get_api()
         database = self.get_database()
         table = self.get_table()
-        return self.process_variables_and_concepts(year, api, database, table).keys()
+        if self.__bundled(year, api, database, table):
+            return dict.fromkeys(self.__bundle.concepts(year, api, database, table)).keys()
+        return self.pull_index(year, api, database, table).concepts.keys()
     
     def set_concepts(self, *args):
         try:
@@ -225,13 +1721,14 @@ class Census:
 
         msg.warn('New concepts set. Variables cleared.')
         concepts = []
-        if args == []:
+        if not args:
             raise ValueError('Blank concept not allowed.')
+        supported = self.pull_concepts()
         for arg in args:
-            if arg in self.pull_concepts():
+            if arg in supported:
                 concepts.append(arg)
             else:
-                raise ValueError(f"Concept {arg} not allowed. Supported concepts for the year {self.get_year()} and the API {self.get_api()} in the database {self.get_database()} and the {self.get_table()} are {self.pull_concepts()}. ")
+                raise ValueError(f"Concept {arg} not allowed. Supported concepts for the year {self.get_year()} and the API {self.get_api()} in the database {self.get_database()} and the {self.get_table()} are {list(supported)}. ")
         self.__concepts = concepts
     
     def get_concepts(self):
@@ -245,31 +1742,10 @@ class Census:
         database = self.get_database()
         api = self.get_api()
         table = self.get_table()
-        data = self.process_variables_and_concepts(year, api, database, table)
         if not as_dataframe:
-            return data
+            return self.process_variables_and_concepts(year, api, database, table)
         else:
-            # Get column names
-            columns = ['concept']
-            for key in data.keys():
-                for variable in data[key]:
-                    for v_key in variable.keys():
-                        if v_key not in columns:
-                            columns.append(v_key)
-            dataframe = {}
-            for column in columns:
-                dataframe[column] = []
-            
-            for key in data.keys():
-                for variable in data[key]:
-                    dataframe['concept'].append(key)
-                    for v_key in variable.keys():
-                        dataframe[v_key].append(variable[v_key])
-                        max_col_len = len(dataframe[v_key])
-                    for col in dataframe.keys():
-                        if len(dataframe[col]) < max_col_len:
-                            dataframe[col].append(None)
-            return pd.DataFrame(dataframe)
+            return build_variables_frame(self.pull_metadata(year, api, database, table, 'variables')['variables'])
     
 
     ### VARIABLES
@@ -279,9 +1755,15 @@ class Census:
                 raise ValueError('Cannot return list and dataframe simultaneously.')
             
             concepts = self.get_concepts()
+            dataset = (self.get_year(), self.get_api(), self.get_database(), self.get_table())
+            if self.__bundled(*dataset) and not as_dataframe:
+                if as_list:
+                    return self.__bundle.variable_names(*dataset, concepts)
+                found = self.__bundle.concepts_and_variables(*dataset, concepts)
+                return {key: found[key] for key in concepts if key in found}
             if as_list:
-                all_concepts = self.pull_concepts_and_variables(as_dataframe=True)
-                return list(all_concepts[all_concepts['concept'].isin(concepts)]['variable'])
+                index = self.pull_index()
+                return [v for concept in concepts for v in index.concepts.get(concept, [])]
             elif as_dataframe:
                 all_concepts = self.pull_concepts_and_variables(as_dataframe=True)
                 return all_concepts[all_concepts['concept'].isin(concepts)]
@@ -291,8 +1773,7 @@ class Census:
         except AttributeError:
             msg.warn('Warning: Variable `concept` not set. Returning all variables.')
             if as_list:
-                all_concepts = self.pull_concepts_and_variables(as_dataframe=True)
-                return list(all_concepts[all_concepts['concept'].isin(concepts)]['variable'])            
+                return list(self.pull_index().variables)
             else:
                 return self.pull_concepts_and_variables(as_dataframe)
 
@@ -300,19 +1781,28 @@ class Census:
         self.__variables = None
 
     def add_variable(self, variable):
+        if variable != 'NAME' and not self.__variable_allowed(variable):
+            raise ValueError(f'Variable {variable} not allowed.')
+
         try:
-            if variable in self.pull_variables(as_list=True) or variable == 'NAME':
-                if variable in self.get_variables():
-                    raise ValueError(f'Variable {variable} already exists.')
-                self.__variables.append(variable)
-            else:
-                raise ValueError(f'Variable {variable} not allowed.')
-        except:
-            self.__variables = []
-            if variable in self.pull_variables(as_list=True):
-                self.__variables.append(variable)
-            else:
-                raise ValueError(f'Variable {variable} not allowed.')
+            variables = self.__variables
+        except AttributeError:
+            variables = None
+        if variables is None:
+            variables = self.__variables = []
+
+        if variable in variables:
+            raise ValueError(f'Variable {variable} already exists.')
+        variables.append(variable)
+
+    def __variable_allowed(self, variable):
+        metadata = self.pull_index().variables.get(variable)
+        if metadata is None:
+            return False
+        try:
+            return metadata['concept'] in self.__concepts
+        except AttributeError:
+            return True
 
     def set_variables(self, *args):
         for arg in args:
@@ -326,26 +1816,121 @@ class Census:
 
         
     
+    ### GROUPS
+    def pull_groups(self, as_list=False):
+        groups = self.pull_metadata(self.get_year(), self.get_api(), self.get_database(), self.get_table(), 'groups')['groups']
+        if as_list:
+            return [g['name'] for g in groups]
+        return groups
+
+    def set_group(self, *groups, annotations=True, moe=True):
+        # Pulls whole tables with get=group(...). Annotation and margin of
+        # error columns can be dropped as the response is parsed.
+        year, api, database, table = self.get_year(), self.get_api(), self.get_database(), self.get_table()
+
+        def build():
+            names = frozenset(g['name'] for g in self.pull_metadata(year, api, database, table, 'groups')['groups'])
+            return names, 64 * len(names)
+
+        supported = self.__metadata_cache.compute((year, api, database, table, 'group-names'), build)
+        invalid = [group for group in groups if group not in supported]
+        if invalid:
+            raise ValueError(f"Groups {invalid} not allowed. Use the `pull_groups()` method to check which groups are available for the year {year} and the API {api} in the database {database} and the {table} table.")
+        self.__groups = tuple(dict.fromkeys(groups))
+        self.__column_options = {'annotations': annotations, 'moe': moe}
+
+    def get_groups(self):
+        try:
+            return self.__groups
+        except AttributeError:
+            return ()
+
+    def clear_groups(self):
+        self.__groups = ()
+        self.__column_options = {}
+
+
     ### GEOGRAPHY
-    def set_geography(self, geography):
+    def get_geography_levels(self, year, api, database, table):
+        return frozenset(g['name'] for g in self.pull_metadata(year, api, database, table, 'geography')['fips'])
+
+    def set_geography(self, geography, parents=None, **kwargs):
+        # Parent geographies go in the `in=` clause, e.g.
+        # set_geography('tract', state='06'). Required parents that are left
+        # out are enumerated when the data is pulled.
         self.__geography_values = None
+        parents = {level: normalize_geography_values(values) for level, values in dict(parents or {}, **kwargs).items()}
 
         if geography in self.pull_geographies(as_list=True):
-            for g in self.pull_geographies():
-                if g['name'] == geography and 'requires' in g:
-                    msg.warn(f"Geography {geography} requires {g['requires']}. Add additional details by using the `set_geography()` method.")
+            spec = self.get_geography_spec(self.get_year(), self.get_api(), self.get_database(), self.get_table(), geography, parents)
+            requires = spec.get('requires', [])
+            for level in parents:
+                if level not in requires:
+                    raise AttributeError(f"Geography {geography} does not take a parent {level}. Supported parents are {requires}.")
+            missing = [level for level in requires if parents.get(level, '*') == '*' and level not in spec.get('wildcard', [])]
+            if missing:
+                msg.warn(f"Geography {geography} requires {requires}. All values of {missing} will be requested one by one when pulling data. Pass them to the `set_geography()` method to narrow this down.")
             self.__geography = geography
+            self.__geography_parents = {level: parents[level] for level in requires if level in parents}
             self.__geography_values = ['*']
             msg.warn(f'Using * to get all of geography {geography}. Use the `set_geography_values()` method to specify.')
         else:
-            raise AttributeError(f"Geography {geography} not allowed. Supported geographies for year {self.get_year()} and API {self.get_api()} and database {self.get_database()} and table {self.get_table()} are {self.process_geographies(self.pull_geographies())}.")
+            raise AttributeError(f"Geography {geography} not allowed. Supported geographies for year {self.get_year()} and API {self.get_api()} and database {self.get_database()} and table {self.get_table()} are {self.pull_geographies(as_list=True)}.")
+
+    def get_geography_parents(self):
+        try:
+            return self.__geography_parents
+        except AttributeError:
+            return {}
+
+    def get_geography_spec(self, year, api, database, table, geography, parents=None):
+        # geography.json can list the same geography more than once with
+        # different parents; prefer the entry that fits the given parents.
+        specs = [g for g in self.pull_metadata(year, api, database, table, 'geography')['fips'] if g['name'] == geography]
+        if not specs:
+            raise AttributeError(f"Geography {geography} not allowed for year {year} and API {api} and database {database} and table {table}.")
+        for spec in specs:
+            if set(parents or {}) <= set(spec.get('requires', [])):
+                return spec
+        return specs[0]
+
+    def expand_parents(self, year, api, database, table, geography, parents=None):
+        # Returns one `in=` clause (a dict of level -> values) per request
+        # needed to cover `geography`. Required parent levels that were not
+        # given and cannot be wildcarded are enumerated from the API.
+        parents = parents or {}
+        spec = self.get_geography_spec(year, api, database, table, geography, parents)
+        shards = [{}]
+        for level in spec.get('requires', []):
+            values = parents.get(level, '*')
+            if values != '*' or level in spec.get('wildcard', []):
+                shards = [dict(shard, **{level: values}) for shard in shards]
+                continue
+
+            listings = self.map_concurrent(lambda shard: self.fetch_geography_values(year, api, database, table, level, shard), shards)
+            expanded = []
+            for shard, rows in zip(shards, listings):
+                if not rows:
+                    continue
+                column = rows[0].index(level)
+                expanded += [dict(shard, **{level: row[column]}) for row in rows[1:]]
+            shards = expanded
+        return shards
+
+    def map_concurrent(self, fn, items):
+        items = list(items)
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            futures = [submit_in_context(executor, fn, item) for item in items]
+            return [future.result() for future in futures]
 
     def pull_geographies(self, as_list=False):
         year = self.get_year()
         api = self.get_api()
         database = self.get_database()
         table = self.get_table()
-        geographies = loads(requests.get(self.get_link(year, api, database, table, 'geography', 'json')).text)['fips']
+        geographies = self.pull_metadata(year, api, database, table, 'geography')['fips']
         if as_list:
             return [g['name'] for g in geographies]
         else:
@@ -358,6 +1943,31 @@ class Census:
         except AttributeError:
             raise AttributeError(f"Variable `geography` not set. Supported geographies for year {self.get_year()} and API {self.get_api()} and database {self.get_database()} and table {self.get_table()} are {self.pull_geographies(as_list=True)}.")
     
+    def fetch_geography_values(self, year, api, database, table, geography, parents=None):
+        shards = self.expand_parents(year, api, database, table, geography, parents)
+        listings = [rows for rows in self.map_concurrent(lambda shard: self.__fetch_listing(year, api, database, table, geography, shard), shards) if rows]
+        if len(listings) <= 1:
+            return listings[0] if listings else []
+        return listings[0][:1] + [row for rows in listings for row in rows[1:]]
+
+    def __fetch_listing(self, year, api, database, table, geography, parents):
+        url = self.get_dataset_url(year, api, database, table) + '?get=NAME&for=' + geography + ':*' + get_in_clause(parents)
+        key = (year, api, database, table, 'geography-values', geography, get_in_clause(parents) or 'all')
+        return self.__cached(key, lambda: self.request(url).text or '[]')
+
+    def pull_geography_labels(self, year, api, database, table, geography, parents=None):
+        # NAME of every value of a geography, indexed by the geography
+        # columns of the listing (e.g. state and county for counties).
+        def build():
+            rows = self.fetch_geography_values(year, api, database, table, geography, parents)
+            header = rows[0]
+            keys = [column for column in header if column != 'NAME']
+            listing = pd.DataFrame(rows[1:], columns=header)
+            labels = listing.set_index(keys)['NAME']
+            return labels, int(labels.memory_usage(deep=True))
+
+        return self.__metadata_cache.compute((year, api, database, table, 'geography-labels', geography, get_in_clause(parents)), build)
+
     def pull_geography_values(self, as_dataframe=False):
         year = self.get_year()
         api = self.get_api()
@@ -366,19 +1976,29 @@ class Census:
         # variables = self.get_variables()
         geography = self.get_geography()
 
-        if table == 'detail':
-            r = requests.get(self.base_url + '/' + '/'.join([year, api, database]) + '?get=NAME&for=' + geography + ':*').text
-        else:
-            r = ast.literal_eval(requests.get(self.base_url + '/' + '/'.join([year, api, database, table]) + '?get=NAME&for=' + geography + ':*').text)
+        r = self.fetch_geography_values(year, api, database, table, geography, self.get_geography_parents())
         if as_dataframe:
-            return pd.DataFrame(r, columns=r[0]).drop(0, axis=0)
+            return decode_rows(r)
         else:
             return r
         
+    def pull_geography_codes(self, year, api, database, table, geography, parents=None):
+        def build():
+            rows = self.fetch_geography_values(year, api, database, table, geography, parents)
+            column = rows[0].index(geography) if rows else 0
+            codes = frozenset(row[column] for row in rows[1:])
+            return codes, 64 * len(codes)
+
+        return self.__metadata_cache.compute((year, api, database, table, 'geography-codes', geography, get_in_clause(parents)), build)
+
+    def check_geography_values(self, values):
+        codes = self.pull_geography_codes(self.get_year(), self.get_api(), self.get_database(), self.get_table(), self.get_geography(), self.get_geography_parents())
+        return [value for value in values if value not in codes]
+
     def add_geography_value(self, value):
         # Check if geography value is okay
-        if value in list(self.pull_geography_values(as_dataframe=True).iloc[:, 1]):
-            value = str(value)
+        value = str(value)
+        if not self.check_geography_values([value]):
             try:
                 if '*' in self.__geography_values:
                     self.__geography_values = [value]
@@ -388,55 +2008,706 @@ class Census:
                 self.__geography_values = [value]
         else:
             raise AttributeError(f"Value {value} not allowed for this geography {self.get_geography()}")
+
+    def set_geography_values(self, *values):
+        if len(values) == 1 and isinstance(values[0], (list, tuple, set)):
+            values = values[0]
+        values = list(dict.fromkeys(str(value) for value in values))
+        if not values:
+            raise ValueError('Blank geography values not allowed.')
+
+        if values != ['*']:
+            invalid = self.check_geography_values(values)
+            if invalid:
+                raise AttributeError(f"Values {invalid} not allowed for this geography {self.get_geography()}")
+        self.__geography_values = values
         
     def get_geography_values(self):
         return self.__geography_values
 
 
     def label_data(self, df):
-        # Get variable labels
-        labels = {}
-        all_variables = self.pull_variables(as_dataframe=True)
-        for v in self.get_variables():
-            labels[v] = list(all_variables.loc[all_variables['variable'] == v, 'label'])[0]
-        
-        df = df.rename(columns=labels)
+        return self.label_frame(df, self.get_query())
 
-        labels = {}
-        all_geography_values = self.pull_geography_values(as_dataframe=True)
+    def label_frame(self, df, query):
+        with self.stats.stage('label', rows=len(df)):
+            return self.__label_frame(df, query)
 
-        for row in df[self.get_geography()]:
-            labels[row] = list(all_geography_values.loc[all_geography_values[self.get_geography()] == row, 'NAME'])[0]
-        
-        df[self.get_geography()] = df[self.get_geography()].replace(labels)
+    def __label_frame(self, df, query):
+        return self.__label_columns(self.__label_geography(df, query), query)
 
+    def __label_geography(self, df, query):
+        names = self.pull_geography_labels(query.year, query.api, query.database, query.table, query.geography, query.get_parents())
+        df[query.geography] = label_geography(df, query.geography, names)
         return df
 
+    def __label_columns(self, df, query):
+        # Get variable labels
+        index = self.pull_index(query.year, query.api, query.database, query.table)
+        variables = list(query.variables) + [v for group in query.groups for v in index.groups.get(group, [])]
+        labels = {v: index.get_label(v, v) for v in variables}
+        if isinstance(df.columns, pd.MultiIndex):
+            # A compacted estimate/MOE pair sits under its code without the
+            # suffix and takes the estimate's label.
+            return df.set_axis(pd.MultiIndex.from_tuples(
+                [(labels.get(name + 'E', name) if kind else labels.get(name, name), kind) for name, kind in df.columns]), axis=1)
+        return df.rename(columns=labels)
 
-    def pull_data(self, as_dataframe=False, labelled=False):
-        year = self.get_year()
-        api = self.get_api()
-        database = self.get_database()
-        table = self.get_table()
-        variables = self.get_variables()
-        geography = self.get_geography()
-        geography_values = self.get_geography_values()
 
+    ### FILTERS
+    def set_filters(self, **filters):
+        # Extra predicates for the query string, e.g. set_filters(AGEGROUP=29)
+        self.__filters = {name: normalize_geography_values(value) for name, value in filters.items()}
 
+    def get_filters(self):
+        try:
+            return self.__filters
+        except AttributeError:
+            return {}
+
+
+    ### QUERIES
+    def get_query(self):
+        groups = self.get_groups()
+        if groups:
+            # A group on its own is a complete query.
+            try:
+                variables = self.get_variables() or []
+            except AttributeError:
+                variables = []
+        else:
+            variables = self.get_variables()
+        return CensusQuery(
+            year=self.get_year(),
+            api=self.get_api(),
+            database=self.get_database(),
+            table=self.get_table(),
+            variables=variables,
+            geography=self.get_geography(),
+            geography_values=self.get_geography_values(),
+            parents=self.get_geography_parents(),
+            filters=self.get_filters(),
+            groups=groups,
+            **self.__column_options,
+        )
+
+    def get_dataset_url(self, year, api, database, table):
         if table == 'detail':
-            url = self.base_url + '/' + '/'.join([year, api, database]) + '?get=' + ','.join(variables) + '&for=' + geography + ':' + ','.join(geography_values)
-            print(url)
-            r = requests.get(url).text
-            return r
+            return self.base_url + '/' + '/'.join([year, api, database])
+        return self.base_url + '/' + '/'.join([year, api, database, table])
+
+    def get_data_url(self, query, variables=None, parents=None):
+        # `variables` and `parents` override the query's, for one chunk or
+        # shard of it.
+        variables = query.get_items() if variables is None else variables
+        parents = query.get_parents() if parents is None else parents
+        url = self.get_dataset_url(query.year, query.api, query.database, query.table) + '?get=' + ','.join(variables) + '&for=' + query.geography + ':' + ','.join(query.geography_values) + get_in_clause(parents)
+        url += ''.join(f'&{name}={value}' for name, value in query.filters)
+        if self.__token:
+            url += '&' + self.get_token_str()
+        return url
+
+    def get_result_store(self):
+        return self.__result_store
+
+    def __request_rows(self, url):
+        if self.__result_store is not None:
+            found, rows = self.__result_store.get(url)
+            self.stats.count('result_store_hits' if found else 'result_store_misses')
+            if found:
+                return rows
+
+        # Connection drops and truncated bodies are retried here on top of
+        # the transport's own retries, so one bad shard does not fail a
+        # large fan-out.
+        attempt = 0
+        while True:
+            try:
+                r = self.request(url, priority=DATA)
+                with self.stats.stage('parse', url=redact(url), bytes=len(r.content)) as info:
+                    rows = [] if r.status_code == 204 or not r.content else loads(r.content)
+                    info['rows'] = max(len(rows) - 1, 0)
+                if self.__result_store is not None:
+                    self.__result_store.put(url, rows)
+                return rows
+            except (requests.RequestException, JSONDecodeError) as e:
+                if attempt >= self.shard_retries:
+                    raise
+                attempt += 1
+                self.stats.count('retries')
+                msg.warn(f'Retrying {redact(url)} ({attempt}/{self.shard_retries}): {e}')
+
+    def fetch_data(self, query, progress=None):
+        # The API accepts at most `max_variables` variables per request, so
+        # wider pulls are split into chunks. Geographies whose required
+        # parents are not given are split into one shard per parent. All
+        # requests run on one bounded thread pool; chunks are joined back
+        # together on the geography columns and shards are appended in order.
+        # `progress(done, total)` is called as requests finish.
+        chunks = query.get_chunks(self.max_variables)
+        shards = self.expand_parents(query.year, query.api, query.database, query.table, query.geography, query.get_parents())
+        urls = {(i, j): self.get_data_url(query, chunk, shard) for i, shard in enumerate(shards) for j, chunk in enumerate(chunks)}
+        levels = self.get_geography_levels(query.year, query.api, query.database, query.table)
+
+        def request(url):
+            return select_columns(self.__request_rows(url), query.annotations, query.moe)
+
+        results = {}
+        if len(urls) == 1:
+            results = {key: request(url) for key, url in urls.items()}
         else:
-            url = self.base_url + '/' + '/'.join([year, api, database, table]) + '?get=' + ','.join(variables) + '&for=' + geography + ':' + ','.join(geography_values)
-        print(url)
-        r = ast.literal_eval(requests.get(url).text)
-        if as_dataframe:
-            if labelled:
-                return self.label_data(pd.DataFrame(r, columns=r[0]).drop(0, axis=0))
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+                futures = {submit_in_context(executor, request, url): key for key, url in urls.items()}
+                for done, future in enumerate(as_completed(futures), 1):
+                    results[futures[future]] = future.result()
+                    if progress is not None:
+                        progress(done, len(futures))
+
+        rows = []
+        for i in range(len(shards)):
+            parts = [results[(i, j)] for j in range(len(chunks))]
+            if not all(parts):
+                continue
+            # Groups return more columns than were asked for, so the width of
+            # each chunk is read from its header.
+            widths = [count_data_columns(part[0], levels) for part in parts]
+            if len(parts) == 1:
+                merged = parts[0]
             else:
-                return pd.DataFrame(r, columns=r[0]).drop(0, axis=0)
-        else:
-            return r
+                with self.stats.stage('merge', chunks=len(parts), rows=len(parts[0]) - 1):
+                    merged = merge_chunks(parts, widths)
+            rows += merged if not rows else merged[1:]
+        return rows
+
+    def stream_data(self, query, batch_size=10000):
+        # Generator version of `fetch_data`. The first item is the header;
+        # after that come lists of at most `batch_size` rows, parsed as the
+        # response arrives. Shards are streamed one after the other. Chunks of
+        # more than `max_variables` variables are streamed side by side and
+        # must list the geographies in the same order, which the API does for
+        # identical geography clauses.
+        chunks = query.get_chunks(self.max_variables)
+        levels = self.get_geography_levels(query.year, query.api, query.database, query.table)
+        batch = []
+        header = None
+        for shard in self.expand_parents(query.year, query.api, query.database, query.table, query.geography, query.get_parents()):
+            responses = []
+            try:
+                for chunk in chunks:
+                    url = self.get_data_url(query, chunk, shard)
+                    responses.append(self.request(url, stream=True, priority=DATA))
+                if any(r.status_code == 204 for r in responses):
+                    continue
+                streams = [iter_rows(self.__count_bytes(r.iter_content(chunk_size=64 * 1024))) for r in responses]
+                headers = [next(stream) for stream in streams]
+                # Dropped columns are removed from each row as it is parsed.
+                keeps = [get_kept_columns(h, query.annotations, query.moe) for h in headers]
+                if any(keep is not None for keep in keeps):
+                    headers = [h if keep is None else [h[k] for k in keep] for h, keep in zip(headers, keeps)]
+                    streams = [stream if keep is None else project_rows(stream, keep) for stream, keep in zip(streams, keeps)]
+                widths = [count_data_columns(h, levels) for h in headers]
+                if header is None:
+                    header = [column for h, width in zip(headers, widths) for column in h[:width]] + headers[0][widths[0]:]
+                    yield header
+
+                for parts in zip(*streams):
+                    row = []
+                    for part, width in zip(parts, widths):
+                        if part[width:] != parts[0][widths[0]:]:
+                            raise ValueError(f'Chunked responses are out of step at geography {parts[0][widths[0]:]}.')
+                        row += part[:width]
+                    batch.append(row + parts[0][widths[0]:])
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+            finally:
+                for r in responses:
+                    r.close()
+        if batch:
+            yield batch
+
+    def __count_bytes(self, chunks):
+        for chunk in chunks:
+            self.stats.count('bytes', len(chunk))
+            yield chunk
+
+    def iter_query(self, query, batch_size=10000, as_dataframe=True, typed=True):
+        types = self.get_query_types(query) if typed else None
+        stream = self.stream_data(query, batch_size)
+        header = next(stream, None)
+        if header is None:
+            return
+        start = 1
+        for batch in stream:
+            self.stats.count('rows', len(batch))
+            if as_dataframe:
+                with self.stats.stage('decode', rows=len(batch)):
+                    df = decode_rows([header] + batch, types, start)
+                yield df
+            else:
+                yield [header] + batch
+            start += len(batch)
+
+    def iter_data(self, batch_size=10000, as_dataframe=True, typed=True):
+        return self.iter_query(self.get_query(), batch_size, as_dataframe, typed)
+
+    def get_variable_types(self, year, api, database, table, variables):
+        index = self.pull_index(year, api, database, table)
+        return {v: index.variables[v].get('predicateType') for v in variables if v in index.variables}
+
+    def get_query_types(self, query):
+        index = self.pull_index(query.year, query.api, query.database, query.table)
+        variables = list(query.variables) + [v for group in query.groups for v in index.groups.get(group, [])]
+        return self.get_variable_types(query.year, query.api, query.database, query.table, variables)
+
+    def invalidate_results(self, query):
+        # Removes every stored response that makes up `query`.
+        shards = self.expand_parents(query.year, query.api, query.database, query.table, query.geography, query.get_parents())
+        for shard in shards:
+            for chunk in query.get_chunks(self.max_variables):
+                self.__result_store.invalidate(self.get_data_url(query, chunk, shard))
+
+    def execute(self, query, as_dataframe=False, labelled=False, typed=True, progress=None, compact=False):
+        # Runs a CensusQuery without touching this object's settings, so one
+        # Census object can serve many threads at once. `compact` returns the
+        # frame from `compact_frame`.
+        with self.stats.stage('pull', year=query.year, dataset='/'.join([query.api, query.database, query.table]), geography=query.geography) as info:
+            r = self.fetch_data(query, progress)
+            info['rows'] = max(len(r) - 1, 0)
+            self.stats.count('rows', info['rows'])
+            if not as_dataframe:
+                return r
+            types = self.get_query_types(query) if typed else None
+            with self.stats.stage('decode', rows=info['rows']):
+                df = decode_rows(r, types)
+            if labelled:
+                with self.stats.stage('label', rows=len(df)):
+                    df = self.__label_geography(df, query)
+            if compact:
+                # Compacted while the columns still have their codes, which
+                # is what estimate/MOE pairs are matched on.
+                with self.stats.stage('compact', rows=len(df)) as compacted:
+                    df = compact_frame(df)
+                    compacted.update(df.attrs['memory'])
+            if labelled:
+                df = self.__label_columns(df, query)
+            return df
+
+    def pull_data(self, as_dataframe=False, labelled=False, typed=True, progress=None, compact=False):
+        return self.execute(self.get_query(), as_dataframe, labelled, typed, progress, compact)
+
+
+    ### EXPORT
+    def export(self, path, query=None, format='parquet', partition_by=('year', 'state'), batch_size=100000):
+        # Streams a pull straight into a partitioned Parquet (or Arrow IPC)
+        # dataset, one batch at a time, so a large pull is never held in
+        # memory as a whole. Partition columns that the result does not have
+        # are ignored. Returns the number of rows and the files written.
+        # The partition values live in the directory names, so read the
+        # dataset back with the same types or `state=06` comes back as 6:
+        #   ds.dataset(path, partitioning=ds.partitioning(
+        #       pa.schema([('year', pa.int32()), ('state', pa.string())]), flavor='hive'))
+        try:
+            import pyarrow as pa
+            import pyarrow.dataset as ds
+        except ImportError:
+            raise ImportError('Exporting requires pyarrow. Install it with `pip install pyarrow`.')
+        if format not in ('parquet', 'ipc', 'arrow', 'feather'):
+            raise ValueError(f'Format {format} not supported. Use parquet or arrow.')
+
+        query = query or self.get_query()
+        types = self.get_query_types(query)
+        files = []
+        rows = 0
+        schema = None
+        for i, df in enumerate(self.iter_query(query, batch_size, as_dataframe=True, typed=True)):
+            df.insert(0, 'year', int(query.year))
+            if schema is None:
+                # Integer columns stay int64 in every batch, with nulls where
+                # the API had no estimate, so all files share one schema.
+                fields = [pa.field('year', pa.int32())]
+                for column in df.columns[1:]:
+                    kind = types.get(column)
+                    fields.append(pa.field(column, pa.int64() if kind == 'int' else pa.float64() if kind == 'float' else pa.string()))
+                schema = pa.schema(fields)
+                partitioning = [column for column in partition_by if column in df.columns]
+                # Typed from the schema, so codes keep their leading zeros.
+                partitioning = ds.partitioning(pa.schema([schema.field(column) for column in partitioning]), flavor='hive') if partitioning else None
+            table = pa.Table.from_arrays([pa.array(df[field.name].to_numpy(), type=field.type, from_pandas=True) for field in schema], schema=schema)
+            ds.write_dataset(
+                table, path,
+                format='parquet' if format == 'parquet' else 'ipc',
+                partitioning=partitioning,
+                basename_template=f'part-{query_id(query)}-{i}-{{i}}.' + ('parquet' if format == 'parquet' else 'arrow'),
+                existing_data_behavior='overwrite_or_ignore',
+                file_visitor=lambda written: files.append(written.path),
+            )
+            rows += len(df)
+        return {'rows': rows, 'files': files}
+
+
+    ### PANELS
+    def pull_panel(self, years, variables=None, geography=None, geography_values=None, parents=None, labelled=False, typed=True):
+        # Pulls the same query for several vintages at once and stacks the
+        # results with a `year` column. The api, database and table come from
+        # the current settings; variables and geography default to them too.
+        # Variables and groups missing from a vintage are left out of that
+        # vintage, and vintages that fail are skipped; both are reported with
+        # warnings and in `df.attrs['missing']` / `df.attrs['failed']`.
+        if not variables:
+            # With groups set, variables are optional as in `get_query`.
+            try:
+                variables = self.get_variables()
+            except AttributeError:
+                if not self.get_groups():
+                    raise
+                variables = []
+        variables = list(variables)
+        if geography is None:
+            geography = self.get_geography()
+            geography_values = geography_values or self.get_geography_values()
+            parents = parents if parents is not None else self.get_geography_parents()
+        template = CensusQuery(self.get_year(), self.get_api(), self.get_database(), self.get_table(),
+                               variables, geography, geography_values or ['*'], parents or {}, self.get_filters(),
+                               self.get_groups(), **self.__column_options)
+        api = template.api
+        database = template.database
+        table = template.table
+
+        missing = {}
+        failed = {}
+        labels = {}
+
+        def pull_year(year):
+            year = str(year)
+            if self.validate and not self.has_dataset(year, api, database, table):
+                failed[year] = f'{api}/{database}/{table} is not available'
+                return None
+            try:
+                index = self.pull_index(year, api, database, table)
+                available = [v for v in variables if v == 'NAME' or v in index]
+                groups = [g for g in template.groups if g in index.groups]
+                absent = [v for v in variables if v not in available] + [g for g in template.groups if g not in groups]
+                if absent:
+                    missing[year] = absent
+                if not available and not groups:
+                    return None
+                query = template.replace(year=year, variables=available, groups=groups)
+                rows = self.fetch_data(query)
+                types = self.get_query_types(query) if typed else None
+                df = decode_rows(rows, types)
+            except (ValueError, AttributeError, requests.RequestException) as e:
+                failed[year] = str(e)
+                return None
+            if labelled and len(df):
+                labels[year] = {v: index.get_label(v, v) for v in available + [v for g in groups for v in index.groups[g]]}
+                names = self.pull_geography_labels(year, api, database, table, query.geography, query.get_parents())
+                df[query.geography] = label_geography(df, query.geography, names)
+            df.insert(0, 'year', int(year))
+            return df
+
+        frames = [df for df in self.map_concurrent(pull_year, years) if df is not None]
+        for year, absent in sorted(missing.items()):
+            msg.warn(f'Warning: {year} does not have the variables or groups {absent}.')
+        for year, error in sorted(failed.items()):
+            msg.warn(f'Warning: Could not pull {year}: {error}')
+
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if labelled:
+            # Labels change wording between vintages; use the latest one so
+            # each variable stays in one column.
+            latest = {}
+            for year in sorted(labels):
+                latest.update(labels[year])
+            df = df.rename(columns=latest)
+        df.attrs['missing'] = missing
+        df.attrs['failed'] = failed
+        return df
+
+
+class AsyncCensus:
+    # Awaitable versions of the Census pulls, for fanning out many queries
+    # with asyncio.gather. Queries run on a pool of worker threads that share
+    # the wrapped Census object's connection pool and caches. One query can
+    # fan out into many requests, so the queries of this AsyncCensus share a
+    # cap of `max_concurrency` requests in flight. Other users of the wrapped
+    # object are not limited by it.
+    #
+    # Each method takes the query explicitly; anything left out is taken from
+    # the wrapped Census object's current settings.
+    def __init__(self, census, max_concurrency=None):
+        self.census = census
+        self.max_concurrency = max_concurrency or census.max_workers
+        self.__executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self.__slots = threading.BoundedSemaphore(self.max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+
+    def __call(self, fn, *args):
+        request_slots.set(self.__slots)
+        return fn(*args)
+
+    async def __run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, contextvars.copy_context().run, partial(self.__call, fn, *args))
+
+    def __dataset(self, year, api, database, table):
+        return (
+            str(year) if year is not None else self.census.get_year(),
+            api or self.census.get_api(),
+            database or self.census.get_database(),
+            table or self.census.get_table(),
+        )
+
+    async def pull_metadata(self, endpoint, year=None, api=None, database=None, table=None):
+        return await self.__run(self.census.pull_metadata, *self.__dataset(year, api, database, table), endpoint)
+
+    async def pull_index(self, year=None, api=None, database=None, table=None):
+        return await self.__run(self.census.pull_index, *self.__dataset(year, api, database, table))
+
+    async def pull_geographies(self, as_list=False, year=None, api=None, database=None, table=None):
+        geographies = (await self.pull_metadata('geography', year, api, database, table))['fips']
+        if as_list:
+            return [g['name'] for g in geographies]
+        return geographies
+
+    async def pull_geography_values(self, geography=None, as_dataframe=False, year=None, api=None, database=None, table=None, parents=None):
+        dataset = self.__dataset(year, api, database, table)
+        if geography is None:
+            geography = self.census.get_geography()
+            if parents is None:
+                parents = self.census.get_geography_parents()
+        r = await self.__run(self.census.fetch_geography_values, *dataset, geography, parents)
+        if as_dataframe:
+            return decode_rows(r)
+        return r
+
+    async def pull_data(self, variables=None, geography=None, geography_values=None, as_dataframe=False, year=None, api=None, database=None, table=None, parents=None):
+        dataset = self.__dataset(year, api, database, table)
+        variables = variables or self.census.get_variables()
+        if geography is None:
+            geography = self.census.get_geography()
+            if geography_values is None:
+                geography_values = self.census.get_geography_values()
+            if parents is None:
+                parents = self.census.get_geography_parents()
+        elif geography_values is None:
+            geography_values = ['*']
+        query = CensusQuery(*dataset, variables, geography, geography_values, parents or {}, self.census.get_filters())
+        return await self.execute(query, as_dataframe)
+
+    async def execute(self, query, as_dataframe=False, labelled=False, typed=True, compact=False):
+        return await self.__run(self.census.execute, query, as_dataframe, labelled, typed, None, compact)
+
+
+### BATCH RUNS
+# A job spec (YAML or JSON) lists pulls as years x datasets x geographies:
+#
+#   output: out
+#   format: parquet            # or csv, json
+#   workers: 4
+#   rate_limit: 5              # requests per second, shared by all workers
+#   jobs:
+#     - name: income
+#       years: [2019, 2020]
+#       api: acs
+#       database: acs5
+#       table: detail
+#       variables: [NAME, B19013_001E]
+#       geography: tract
+#       parents: {state: '06'}
+#
+# Each job is split into one query per year and per required parent (see
+# `Census.expand_parents`). That shard is the unit that runs on the process
+# pool and is checkpointed: its output file is written under a temporary
+# name and renamed when complete, so a rerun skips every shard whose file
+# exists and picks up where the last run stopped.
+JOB_FIELDS = ('variables', 'geography', 'geography_values', 'parents', 'filters', 'groups', 'annotations', 'moe')
+BATCH_FORMATS = ('parquet', 'csv', 'json')
+
+batch_client = None
+
+
+def load_job_spec(path):
+    with open(path) as f:
+        text = f.read()
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('YAML job specs require PyYAML. Install it with `pip install pyyaml`, or use JSON.')
+        return yaml.safe_load(text)
+    return loads(text)
+
+
+def plan_batch(census, spec, output, format):
+    # Returns (path, query) for every shard in the spec.
+    shards = []
+    for i, job in enumerate(spec.get('jobs', [])):
+        name = str(job.get('name', f'job{i + 1}'))
+        if 'geography' not in job:
+            raise ValueError(f'Job {name} has no geography.')
+        dataset = [job.get(key) for key in ('api', 'database', 'table')]
+        if None in dataset:
+            raise ValueError(f'Job {name} needs an api, a database and a table.')
+        options = {field: job[field] for field in JOB_FIELDS if field in job}
+        options.setdefault('variables', ())
+        for year in job.get('years', [job.get('year')]):
+            if year is None:
+                raise ValueError(f'Job {name} has no year or years.')
+            if census.validate and not census.has_dataset(year, *dataset):
+                msg.warn(f'Warning: Skipping {name} for {year}: {"/".join(dataset)} is not available.')
+                continue
+            query = CensusQuery(year, *dataset, **options)
+            for parents in census.expand_parents(query.year, *dataset, query.geography, query.get_parents()):
+                shard = query.replace(parents=to_pairs(parents))
+                path = os.path.join(output, name, query.year, f'{query.geography}-{query_id(shard)}.{format}')
+                shards.append((path, shard))
+    return shards
+
+
+def write_frame(df, path, format):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    if format == 'parquet':
+        df.to_parquet(tmp, index=False)
+    elif format == 'csv':
+        df.to_csv(tmp, index=False)
+    else:
+        df.to_json(tmp, orient='records')
+    os.replace(tmp, path)
+
+
+def start_batch_worker(token, options, limit):
+    # The limiter holds thread locks, which cannot be pickled to a spawned
+    # worker, so each worker builds its own on the shared file.
+    global batch_client
+    batch_client = Census(token, rate_limit=RateLimiter(**limit), **options)
+
+
+def run_batch_shard(query, path, format):
+    df = batch_client.execute(query, as_dataframe=True)
+    df.insert(0, 'year', int(query.year))
+    write_frame(df, path, format)
+    return len(df)
+
+
+def run_batch(spec, token=None, output=None, format=None, workers=None, rate_limit=None, progress=None, **census_options):
+    # Runs (or resumes) every shard of a job spec, given as a dict or a path,
+    # on a pool of worker processes. Arguments override the spec. On POSIX
+    # the rate limit is kept in a file in the output directory, so all
+    # workers share it. `progress(done, total)` is called as shards finish. Returns counts
+    # of shards and rows, and the error of every shard that failed.
+    if not isinstance(spec, dict):
+        spec = load_job_spec(spec)
+    token = token or spec.get('token') or os.environ.get('CENSUS_API_KEY')
+    if not token:
+        raise ValueError('No API key. Pass `token`, set it in the spec, or set CENSUS_API_KEY.')
+    output = output or spec.get('output', 'census_output')
+    format = format or spec.get('format', 'parquet')
+    if format not in BATCH_FORMATS:
+        raise ValueError(f'Format {format} not supported. Use one of {BATCH_FORMATS}.')
+    workers = workers or spec.get('workers', 4)
+    rate_limit = rate_limit or spec.get('rate_limit', 5)
+
+    os.makedirs(output, exist_ok=True)
+    limit = dict(rate=rate_limit, burst=max(1, int(rate_limit * 2)))
+    if os.name == 'posix':
+        limit['path'] = os.path.join(output, '.rate_limit')
+    census = Census(token, rate_limit=RateLimiter(**limit), **census_options)
+    shards = plan_batch(census, spec, output, format)
+    pending = [(path, query) for path, query in shards if not os.path.exists(path)]
+    result = {'shards': len(shards), 'skipped': len(shards) - len(pending), 'done': 0, 'rows': 0, 'failed': {}}
+    if not pending:
+        return result
+
+    # Importing this pulls in multiprocessing, so it waits until needed.
+    from concurrent.futures import ProcessPoolExecutor
+
+    # The workers were validated against the catalog here already.
+    worker_options = dict(census_options, validate=False)
+    workers = min(workers, len(pending))
+    if 'path' not in limit:
+        # Without fcntl there is no shared bucket: split the rate instead.
+        limit = dict(rate=rate_limit / workers, burst=max(1, int(rate_limit * 2 / workers)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_batch_worker, initargs=(token, worker_options, limit)) as executor:
+        futures = {executor.submit(run_batch_shard, query, path, format): path for path, query in pending}
+        for i, future in enumerate(as_completed(futures)):
+            path = futures[future]
+            try:
+                result['rows'] += future.result()
+                result['done'] += 1
+            except Exception as e:
+                result['failed'][path] = f'{type(e).__name__}: {e}'
+                msg.warn(f'Warning: {path} failed: {e}')
+            if progress is not None:
+                progress(i + 1, len(pending))
+    return result
+
+
+def build_metadata_bundle(census, path, datasets, endpoints=('variables', 'geography', 'groups')):
+    # Fetches the metadata documents of every (year, api, database, table)
+    # in `datasets` concurrently and writes them to one bundle at `path`.
+    # Datasets may also be given as 'year/api/database[/table]'. Documents
+    # that cannot be fetched are left out with a warning.
+    datasets = [tuple(d.split('/')) if isinstance(d, str) else tuple(d) for d in datasets]
+    datasets = [tuple(str(part) for part in d) + ('detail',) * (4 - len(d)) for d in datasets]
+
+    def fetch(item):
+        dataset, endpoint = item
+        return loads(census.request(census.get_link(*dataset, endpoint, 'json')).text)
+
+    items = [(dataset, endpoint) for dataset in datasets for endpoint in endpoints]
+    documents = {dataset: {} for dataset in datasets}
+    with census.stats.stage('bundle', tables=len(datasets)):
+        with ThreadPoolExecutor(max_workers=census.max_workers) as executor:
+            futures = {executor.submit(fetch, item): item for item in items}
+            for future in as_completed(futures):
+                dataset, endpoint = futures[future]
+                try:
+                    documents[dataset][endpoint] = future.result()
+                except (ValueError, requests.RequestException) as e:
+                    msg.warn(f'Warning: Could not fetch {endpoint} for {bundle_key(*dataset)}: {e}')
+        return write_metadata_bundle(path, {dataset: docs for dataset, docs in documents.items() if docs})
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='census', description='Run batches of Census API pulls and build metadata bundles.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run, or resume, the jobs in a YAML or JSON spec')
+    run.add_argument('spec')
+    run.add_argument('--token', help='API key (default: from the spec, then $CENSUS_API_KEY)')
+    run.add_argument('--output', help='output directory')
+    run.add_argument('--format', choices=BATCH_FORMATS)
+    run.add_argument('--workers', type=int, help='worker processes')
+    run.add_argument('--rate-limit', type=float, help='requests per second, shared by all workers')
+    bundle = commands.add_parser('bundle', help='write the metadata of some tables to a memory-mapped bundle')
+    bundle.add_argument('path')
+    bundle.add_argument('datasets', nargs='+', help='tables as year/api/database[/table], e.g. 2020/acs/acs5/subject')
+    bundle.add_argument('--token', help='API key (default: $CENSUS_API_KEY)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'bundle':
+        census = Census(args.token or os.environ.get('CENSUS_API_KEY'), validate=False)
+        build_metadata_bundle(census, args.path, args.datasets)
+        print(f'Wrote {args.path} ({os.path.getsize(args.path)} bytes)')
+        return 0
+
+    def progress(done, total):
+        print(f'\r{done}/{total} shards', end='', flush=True)
+
+    result = run_batch(args.spec, args.token, args.output, args.format, args.workers, args.rate_limit, progress)
+    print(f'\n{result["done"]} shards done ({result["rows"]} rows), {result["skipped"]} already done, {len(result["failed"])} failed')
+    return 1 if result['failed'] else 0
+
 
+if __name__ == '__main__':
+    raise SystemExit(main())